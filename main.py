@@ -28,7 +28,7 @@ import nest_asyncio # Added to allow nested asyncio loops
 
 # --- Local Imports ---
 from utils import (
-    TOKEN, ADMIN_ID, init_db, load_all_data, LANGUAGES, THEMES,
+    TOKEN, ADMIN_ID, init_db, load_all_data, load_unreachable_users, LANGUAGES, THEMES,
     SUPPORT_USERNAME, BASKET_TIMEOUT, clear_all_expired_baskets,
     SECONDARY_ADMIN_IDS, WEBHOOK_URL,
     get_db_connection,
@@ -37,12 +37,12 @@ from utils import (
     send_message_with_retry,
     log_admin_action,
     format_currency,
-    clean_expired_pending_payments,
-    get_expired_payments_for_notification,
+    collect_and_clean_expired_payments,
     clean_abandoned_reservations,
-    get_crypto_price_eur,
     get_first_primary_admin_id, # Admin helper for notifications
     is_user_banned,  # Import ban check helper
+    set_bot_loop,  # Lets utils' background jobs reach the bot loop
+    start_admin_log_writer,
     BOT_TOKENS  # Multi-bot support
 )
 
@@ -607,11 +607,8 @@ async def clear_expired_baskets_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
 async def clean_expired_payments_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
     logger.debug("Running background job: clean_expired_payments_job")
     try:
-        # Get the list of expired payments before cleaning them up
-        expired_user_notifications = await asyncio.to_thread(get_expired_payments_for_notification)
-        
-        # Clean up the expired payments
-        await asyncio.to_thread(clean_expired_pending_payments)
+        # One scan of expired payments: clean them up and get the users to notify
+        expired_user_notifications = await asyncio.to_thread(collect_and_clean_expired_payments)
         
         # Send notifications to users
         if expired_user_notifications:
@@ -629,11 +626,11 @@ async def clean_abandoned_reservations_job_wrapper(context: ContextTypes.DEFAULT
 
 
 async def payment_recovery_job_wrapper(context: ContextTypes.DEFAULT_TYPE):
-    """BULLETPROOF: Wrapper for payment recovery job"""
+    """BULLETPROOF: Wrapper for the payment recovery + health check tick"""
     logger.debug("Running background job: payment_recovery_job")
     try:
-        from utils import run_payment_recovery_job
-        await asyncio.to_thread(run_payment_recovery_job)
+        from utils import run_payment_recovery_tick
+        await asyncio.to_thread(run_payment_recovery_tick)
     except Exception as e:
         logger.error(f"❌ BULLETPROOF: Error in payment recovery job: {e}", exc_info=True)
 
@@ -825,6 +822,8 @@ def main() -> None:
     logger.info(f"🤖 Multi-bot mode: Initializing {len(BOT_TOKENS)} bot(s)...")
     init_db()
     load_all_data()
+    load_unreachable_users()
+    start_admin_log_writer()
     defaults = Defaults(parse_mode=None, block=False)
     
     applications = []
@@ -876,6 +875,7 @@ def main() -> None:
         telegram_app = applications[0]
     
     main_loop = asyncio.get_event_loop()
+    set_bot_loop(main_loop, telegram_app)
     
     # Setup background jobs only on first bot (they operate on shared database)
     if BASKET_TIMEOUT > 0 and applications:
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# utils validates these at import time
+os.environ.setdefault("TOKEN", "123456:" + "A" * 35)
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("WEBHOOK_URL", "https://example.invalid")
+
+
+@pytest.fixture
+def utils_db(tmp_path, monkeypatch):
+    """utils, initialized against a fresh database in tmp_path."""
+    pytest.importorskip("telegram")
+    import utils
+    monkeypatch.setattr(utils, "DATABASE_PATH", str(tmp_path / "shop.db"))
+    monkeypatch.setattr(utils, "db_pool", utils.DBConnectionPool())
+    utils.init_db()
+    return utils
@@ -0,0 +1,27 @@
+import threading
+import time
+
+
+def test_full_broadcast_batch_is_flushed_off_the_calling_thread(utils_db, monkeypatch):
+    real_flush = utils_db.flush_broadcast_status_updates
+    release, flush_threads = threading.Event(), []
+
+    def blocked_flush(): # Stands in for a flush stuck behind another writer's lock
+        release.wait(5)
+        flush_threads.append(threading.current_thread())
+        real_flush()
+
+    monkeypatch.setattr(utils_db, "BROADCAST_STATUS_FLUSH_SIZE", 3)
+    monkeypatch.setattr(utils_db, "flush_broadcast_status_updates", blocked_flush)
+
+    started = time.monotonic()
+    for user_id in (1, 2, 3, 4):
+        utils_db.update_user_broadcast_status(user_id, success=False)
+    assert time.monotonic() - started < 1 # The size-triggered flush didn't run on this thread
+
+    release.set()
+    deadline = time.monotonic() + 5
+    while utils_db._broadcast_status_queue and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not utils_db._broadcast_status_queue
+    assert flush_threads and threading.current_thread() not in flush_threads
@@ -0,0 +1,52 @@
+import sqlite3
+from datetime import datetime, timedelta, timezone
+
+
+def _add_order(utils, payment_id, wallet_status, wallet_age=timedelta(days=2)):
+    """A purchase pending_deposits row created two days ago, plus its solana_wallets row unless wallet_status is None."""
+    now = datetime.now(timezone.utc)
+    conn = sqlite3.connect(utils.DATABASE_PATH)
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO users (user_id) VALUES (7)")
+        conn.execute(
+            "INSERT INTO pending_deposits (payment_id, user_id, currency, target_eur_amount, expected_crypto_amount, "
+            "created_at, is_purchase, basket_snapshot_json) VALUES (?, 7, 'sol', 10, 0.1, ?, 1, ?)",
+            (payment_id, (now - timedelta(days=2)).isoformat(), '[{"product_id": 1}]'))
+        if wallet_status is not None:
+            conn.execute(
+                "INSERT INTO solana_wallets (user_id, order_id, public_key, private_key, expected_amount, status, updated_at) "
+                "VALUES (7, ?, ?, 'sk', 0.1, ?, ?)",
+                (payment_id, f"pk_{payment_id}", wallet_status, (now - wallet_age).strftime('%Y-%m-%d %H:%M:%S')))
+    conn.close()
+
+
+def test_recovery_selects_paid_wallets_only(utils_db):
+    _add_order(utils_db, "paid", "paid")
+    _add_order(utils_db, "swept", "swept")
+    _add_order(utils_db, "paid_just_now", "paid", wallet_age=timedelta(0))
+    _add_order(utils_db, "unpaid", "pending")
+    _add_order(utils_db, "no_wallet", None)
+
+    recovered = {p['payment_id'] for p in utils_db.iter_failed_payments_for_recovery()}
+
+    assert recovered == {"paid", "swept"}
+
+
+def test_expiry_cleanup_leaves_paid_orders_to_recovery(utils_db):
+    # Recovery backs off for longer than PAYMENT_TIMEOUT_MINUTES, so a paid order still being retried
+    # (or already given up on) must not be deleted by the expired-payment cleanup meanwhile.
+    _add_order(utils_db, "paid_retrying", "paid")
+    _add_order(utils_db, "swept_given_up", "swept")
+    _add_order(utils_db, "unpaid", "pending")
+    _add_order(utils_db, "no_wallet", None)
+    conn = sqlite3.connect(utils_db.DATABASE_PATH)
+    with conn:
+        conn.execute("UPDATE pending_deposits SET retry_count = 4, next_retry_at = '2999-01-01 00:00:00' WHERE payment_id = 'paid_retrying'")
+        conn.execute("UPDATE pending_deposits SET retry_count = ? WHERE payment_id = 'swept_given_up'", (utils_db.RECOVERY_MAX_RETRIES,))
+
+    notified = utils_db.collect_and_clean_expired_payments()
+
+    remaining = {row[0] for row in conn.execute("SELECT payment_id FROM pending_deposits")}
+    conn.close()
+    assert remaining == {"paid_retrying", "swept_given_up"}
+    assert len(notified) == 2
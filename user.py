@@ -20,11 +20,12 @@ import telegram.error as telegram_error
 from utils import (
     CITIES, DISTRICTS, PRODUCT_TYPES, THEMES, LANGUAGES, BOT_MEDIA, ADMIN_ID, BASKET_TIMEOUT, MIN_DEPOSIT_EUR,
     format_currency, get_progress_bar, send_message_with_retry, format_discount_value,
-    clear_expired_basket, fetch_last_purchases, get_user_status, fetch_reviews,
+    clear_expired_basket, basket_item_str, fetch_last_purchases, get_user_status, fetch_reviews,
     SOLANA_ADMIN_WALLET, # Check if Solana is configured
     get_db_connection, MEDIA_DIR, # Import helper and MEDIA_DIR
     DEFAULT_PRODUCT_EMOJI, # Import default emoji
     load_active_welcome_message, # <<< Import welcome message loader (though we'll modify its usage)
+    get_active_welcome_template, # Cached (active name, template text) for the start menu
     DEFAULT_WELCOME_MESSAGE, # <<< Import default welcome message fallback
     _get_lang_data, # <<< IMPORT THE HELPER FROM UTILS >>>
     _unreserve_basket_items, # <<< IMPORT UNRESERVE HELPER >>>
@@ -98,15 +99,6 @@ def _build_start_menu_content(user_id: int, username: str, lang_data: dict, cont
             balance = Decimal(str(result['balance'])) if result['balance'] else Decimal('0.0')
             purchases = result['total_purchases'] or 0
 
-        # Get active welcome template name setting
-        c.execute("SELECT setting_value FROM bot_settings WHERE setting_key = ?", ("active_welcome_message_name",))
-        setting_row = c.fetchone()
-        if setting_row and setting_row['setting_value']:
-            active_template_name_from_db = setting_row['setting_value']
-            logger.info(f"Active welcome template name from settings: '{active_template_name_from_db}'")
-        else:
-            logger.info("Active welcome message name not found in settings, falling back to 'default'.")
-
     except sqlite3.Error as e:
         logger.error(f"Database error fetching initial data for start menu build (user {user_id}): {e}", exc_info=True)
     except Exception as e:
@@ -135,24 +127,17 @@ def _build_start_menu_content(user_id: int, username: str, lang_data: dict, cont
     # --- Determine which template text to use ---
     welcome_template_to_use = None # Start with None
 
-    if active_template_name_from_db: # Only try if we have a name (even if it's 'default')
-        conn_load = None
-        try:
-            conn_load = get_db_connection()
-            c_load = conn_load.cursor()
-            c_load.execute("SELECT template_text FROM welcome_messages WHERE name = ?", (active_template_name_from_db,))
-            template_row = c_load.fetchone()
-            if template_row:
-                welcome_template_to_use = template_row['template_text']
-                logger.info(f"Using welcome message template from DB: '{active_template_name_from_db}'")
-            else:
-                logger.warning(f"Active template '{active_template_name_from_db}' set in DB but not found in templates table. Will fall back.")
-                # welcome_template_to_use remains None
-        except sqlite3.Error as e:
-            logger.error(f"DB error loading specific welcome template '{active_template_name_from_db}': {e}")
+    try:
+        # Active name + template come from an in-memory cache revalidated against the DB (no queries when unchanged)
+        active_template_name_from_db, welcome_template_to_use = get_active_welcome_template()
+        if welcome_template_to_use is not None:
+            logger.debug(f"Using welcome message template from DB: '{active_template_name_from_db}'")
+        else:
+            logger.warning(f"Active template '{active_template_name_from_db}' set in DB but not found in templates table. Will fall back.")
             # welcome_template_to_use remains None
-        finally:
-            if conn_load: conn_load.close()
+    except sqlite3.Error as e:
+        logger.error(f"DB error loading active welcome template: {e}")
+        # welcome_template_to_use remains None
 
     # Fallback logic if DB load failed or no active name was determined initially
     if welcome_template_to_use is None:
@@ -797,7 +782,7 @@ async def handle_add_to_basket(update: Update, context: ContextTypes.DEFAULT_TYP
             return
         c.execute("SELECT basket FROM users WHERE user_id = ?", (user_id,))
         user_basket_row = c.fetchone(); current_basket_str = user_basket_row['basket'] if user_basket_row else ''
-        timestamp = time.time(); new_item_str = f"{product_id_reserved}:{timestamp}"
+        timestamp = round(time.time(), 3); new_item_str = basket_item_str(product_id_reserved, timestamp)
         new_basket_str = f"{current_basket_str},{new_item_str}" if current_basket_str else new_item_str
         c.execute("UPDATE users SET basket = ? WHERE user_id = ?", (new_basket_str, user_id))
         conn.commit()
@@ -1458,14 +1443,16 @@ async def handle_remove_from_basket(update: Update, context: ContextTypes.DEFAUL
     except ValueError: logger.warning(f"Invalid product_id format user {user_id}: {params[0]}"); await query.answer("Error: Invalid product data.", show_alert=True); return
 
     logger.info(f"Attempting remove product {product_id_to_remove} user {user_id}.")
-    item_removed_from_context = False; item_to_remove_str = None; conn = None
+    item_removed_from_context = False; item_to_remove_str = None; legacy_item_str = None; conn = None
     current_basket_context = context.user_data.get("basket", []); new_basket_context = []
     found_item_index = -1
 
     for index, item in enumerate(current_basket_context):
         if item.get('product_id') == product_id_to_remove:
             found_item_index = index
-            try: timestamp_float = float(item['timestamp']); item_to_remove_str = f"{item['product_id']}:{timestamp_float}"
+            try:
+                timestamp_float = float(item['timestamp']); item_to_remove_str = basket_item_str(item['product_id'], timestamp_float)
+                legacy_item_str = f"{item['product_id']}:{timestamp_float}" # Baskets written before ms timestamps
             except (ValueError, TypeError, KeyError) as e: logger.error(f"Invalid format in context item {item}: {e}"); item_to_remove_str = None
             break
 
@@ -1486,6 +1473,7 @@ async def handle_remove_from_basket(update: Update, context: ContextTypes.DEFAUL
         db_basket_result = c.fetchone(); db_basket_str = db_basket_result['basket'] if db_basket_result else ''
         if db_basket_str and item_to_remove_str:
             items_list = db_basket_str.split(',')
+            if item_to_remove_str not in items_list and legacy_item_str in items_list: item_to_remove_str = legacy_item_str
             if item_to_remove_str in items_list:
                 items_list.remove(item_to_remove_str); new_db_basket_str = ','.join(items_list)
                 c.execute("UPDATE users SET basket = ? WHERE user_id = ?", (new_db_basket_str, user_id)); logger.debug(f"Updated DB basket user {user_id} to: {new_db_basket_str}")
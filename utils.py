@@ -3,13 +3,32 @@ import time
 import os
 import logging
 import json
+import re
 import shutil
 import tempfile
 import asyncio
+import random
+import atexit
+import heapq
+from bisect import bisect_right
 from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from decimal import Decimal, ROUND_DOWN, ROUND_UP
 import requests
-from collections import Counter, defaultdict # Moved higher up
+from collections import Counter, OrderedDict, defaultdict, deque # Moved higher up
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing, contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from itertools import islice
+from typing import Iterator
+# Optional faster JSON decoder for basket snapshots (stdlib json if orjson isn't installed)
+try:
+    import orjson
+    _fast_json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    _fast_json_loads = json.loads
 
 # --- Telegram Imports ---
 from telegram import Update, Bot
@@ -89,6 +108,12 @@ if SECONDARY_ADMIN_IDS_STR:
     try: SECONDARY_ADMIN_IDS = [int(uid.strip()) for uid in SECONDARY_ADMIN_IDS_STR.split(',') if uid.strip()]
     except ValueError: logger.warning("SECONDARY_ADMIN_IDS contains non-integer values. Ignoring.")
 
+# O(1) membership sets for the admin checks run on every handler. The lists above stay as-is:
+# callers rely on their order (first primary admin) and concatenate them into SQL parameters.
+_PRIMARY_ADMIN_ID_SET = frozenset(PRIMARY_ADMIN_IDS)
+_SECONDARY_ADMIN_ID_SET = frozenset(SECONDARY_ADMIN_IDS)
+_ALL_ADMIN_IDS = _PRIMARY_ADMIN_ID_SET | _SECONDARY_ADMIN_ID_SET
+
 BASKET_TIMEOUT = 15 * 60 # Default
 try:
     BASKET_TIMEOUT = int(BASKET_TIMEOUT_MINUTES_STR) * 60
@@ -153,6 +178,17 @@ def get_bot_by_id(bot_id: str):
         logger.warning(f"📱 Bot {bot_id} not found in BOT_REGISTRY. Available: {list(BOT_REGISTRY.keys())}")
     return bot
 
+# The bot's event loop and first Application, registered by main.py at startup for jobs that run in
+# worker threads. main.py runs as __main__, so `import main` from here would load a second copy of it
+# whose main_loop/telegram_app are never set.
+_bot_loop: asyncio.AbstractEventLoop | None = None
+_bot_app = None
+
+def set_bot_loop(loop: asyncio.AbstractEventLoop, app):
+    """Register the bot's event loop and Application for background notifications."""
+    global _bot_loop, _bot_app
+    _bot_loop, _bot_app = loop, app
+
 # --- Constants ---
 THEMES = {
     "default": {"product": "💎", "basket": "🛒", "review": "📝"},
@@ -1133,11 +1169,14 @@ CACHE_EXPIRY_SECONDS = 900
 
 import threading
 from functools import wraps
-# Queue import removed - no longer using connection pool
+import queue # Small reader/writer pool for hot read paths (DBConnectionPool)
 import time as time_module
 
 # Database settings - SIMPLE connection model (no pool needed with SQLite WAL)
 _DB_BUSY_TIMEOUT = 60000  # 60 seconds busy timeout for SQLite
+# Page cache per connection, in KiB. DBConnectionPool keeps ~6 connections open for the life of the process
+# (4 readers, the writer, the telemetry writer), each holding its cache, so this is sized for ~100MB in total.
+_DB_CACHE_SIZE_KIB = 16000
 _db_dir_created = False
 
 def _ensure_db_dir():
@@ -1179,7 +1218,7 @@ def get_db_connection():
     # Enable foreign keys
     conn.execute("PRAGMA foreign_keys=ON;")
     # Increase cache for better performance
-    conn.execute("PRAGMA cache_size=10000;")
+    conn.execute(f"PRAGMA cache_size=-{_DB_CACHE_SIZE_KIB};")
     # Memory-mapped I/O for faster reads
     conn.execute("PRAGMA mmap_size=268435456;")  # 256MB
     conn.row_factory = sqlite3.Row
@@ -1283,7 +1322,141 @@ class DBTransaction:
         return False  # Don't suppress exceptions
 
 
+class DBConnectionPool:
+    """
+    Small pool of long-lived connections: up to `readers` reader connections plus ONE dedicated writer
+    (and a separate telemetry writer for broadcast status batches).
+    Usage:
+        with db_pool.acquire() as conn:          # reads (broadcast targeting, template listings)
+            conn.execute("SELECT ...")
+        with db_pool.acquire_writer() as conn:   # writes; serialized in-process on the single writer
+            conn.execute("BEGIN IMMEDIATE"); ...; conn.commit()
+        with db_pool.acquire_telemetry_writer() as conn:  # broadcast status only (relaxed durability, see below)
+    Connections come from get_db_connection() plus in-memory temp tables; their page caches stay warm between calls.
+    A connection handed back mid-transaction is rolled back; one that can't be reset is discarded.
+    If every reader is busy, a throwaway connection is used rather than blocking the caller.
+    """
+    def __init__(self, readers: int = 4):
+        self._readers = queue.LifoQueue(maxsize=readers) # LIFO keeps the warmest cache in use
+        self._writer: sqlite3.Connection | None = None
+        self._writer_lock = threading.Lock()
+        self._telemetry_writer: sqlite3.Connection | None = None
+        self._telemetry_lock = threading.Lock()
+
+    @staticmethod
+    def _open() -> sqlite3.Connection:
+        conn = get_db_connection()
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        # No cache_size override: get_db_connection()'s _DB_CACHE_SIZE_KIB is sized for the whole pool
+        return conn
+
+    @staticmethod
+    def _reset(conn: sqlite3.Connection) -> bool:
+        """Make a returned connection safe for the next caller. False if it should be dropped."""
+        try:
+            if conn.in_transaction: conn.rollback()
+            conn.row_factory = sqlite3.Row # Callers may have swapped it
+            return True
+        except sqlite3.Error as e:
+            logger.warning(f"Discarding pooled DB connection: {e}")
+            return_db_connection(conn)
+            return False
+
+    @contextmanager
+    def acquire(self):
+        try: conn = self._readers.get_nowait()
+        except queue.Empty: conn = self._open()
+        try:
+            yield conn
+        finally:
+            if self._reset(conn):
+                try: self._readers.put_nowait(conn)
+                except queue.Full: return_db_connection(conn) # Overflow connection
+
+    @contextmanager
+    def acquire_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._open()
+            try:
+                yield self._writer
+            finally:
+                if not self._reset(self._writer):
+                    self._writer = None
+
+    @staticmethod
+    def _open_telemetry() -> sqlite3.Connection:
+        conn = DBConnectionPool._open()
+        # DURABILITY TRADE-OFF: this connection only writes broadcast telemetry (broadcast_failed_count,
+        # last_active). With WAL + synchronous=NORMAL a commit is not fsynced; the last few batches can be
+        # lost on power failure/OS crash (never on an app crash) but the DB stays consistent. OFF is NOT used:
+        # checkpoints run from this connection would then skip fsync too, risking the money tables in the same file.
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA wal_autocheckpoint=2000;") # Checkpoint every ~2000 pages instead of 1000 after its commits
+        return conn
+
+    @contextmanager
+    def acquire_telemetry_writer(self):
+        """Dedicated writer for loss-tolerant telemetry; never use it for purchases/balances/pending_deposits."""
+        with self._telemetry_lock:
+            if self._telemetry_writer is None:
+                self._telemetry_writer = self._open_telemetry()
+            try:
+                yield self._telemetry_writer
+            finally:
+                if not self._reset(self._telemetry_writer):
+                    self._telemetry_writer = None
+
+db_pool = DBConnectionPool()
+
+
 # --- Database Initialization ---
+# Index DDL run by init_db() as one script inside a single transaction
+_SCHEMA_INDEX_DDL = """
+    CREATE INDEX IF NOT EXISTS idx_product_media_product_id ON product_media(product_id);
+    CREATE INDEX IF NOT EXISTS idx_purchases_date ON purchases(purchase_date);
+    CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_districts_city_name ON districts(city_id, name);
+    CREATE INDEX IF NOT EXISTS idx_products_location_type ON products(city, district, product_type);
+    CREATE INDEX IF NOT EXISTS idx_reviews_user ON reviews(user_id);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_discount_code_unique ON discount_codes(code);
+    CREATE INDEX IF NOT EXISTS idx_pending_deposits_user_id ON pending_deposits(user_id);
+    CREATE INDEX IF NOT EXISTS idx_admin_log_timestamp ON admin_log(timestamp);
+    CREATE INDEX IF NOT EXISTS idx_users_banned ON users(is_banned);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_welcome_message_name ON welcome_messages(name);
+    -- <<< ADDED Indices for reseller >>>
+    CREATE INDEX IF NOT EXISTS idx_users_is_reseller ON users(is_reseller);
+    CREATE INDEX IF NOT EXISTS idx_reseller_discounts_user_id ON reseller_discounts(reseller_user_id);
+    -- <<< Solana payment indices for high concurrency >>>
+    CREATE INDEX IF NOT EXISTS idx_solana_wallets_status ON solana_wallets(status);
+    CREATE INDEX IF NOT EXISTS idx_solana_wallets_user_id ON solana_wallets(user_id);
+    CREATE INDEX IF NOT EXISTS idx_solana_wallets_created_at ON solana_wallets(created_at);
+    CREATE INDEX IF NOT EXISTS idx_payment_queue_status ON payment_queue(status);
+    CREATE INDEX IF NOT EXISTS idx_payment_queue_user_id ON payment_queue(user_id);
+    -- <<< Payment recovery scan: (is_purchase, created_at) range scan already in ORDER BY order >>>
+    -- (the wallet lookup by order_id uses solana_wallets' UNIQUE(order_id) index)
+    CREATE INDEX IF NOT EXISTS idx_pending_deposits_purchase_created ON pending_deposits(is_purchase, created_at);
+    -- <<< Broadcast targeting indices >>>
+    CREATE INDEX IF NOT EXISTS idx_users_active_purchases ON users(is_banned, total_purchases);
+    -- <<< END ADDED >>>
+
+    -- <<< Last purchase denormalized onto users (trigger on purchases) for broadcast targeting >>>
+    -- Every purchases insert (finalization, manual admin inserts, ...) keeps users.last_purchase_* current.
+    -- Rows of one purchase share purchase_date, so >= lets the last inserted item's city win, as before.
+    CREATE TRIGGER IF NOT EXISTS trg_purchases_user_last_purchase AFTER INSERT ON purchases BEGIN
+        UPDATE users SET last_purchase_date = NEW.purchase_date, last_purchase_city = NEW.city
+        WHERE user_id = NEW.user_id AND (last_purchase_date IS NULL OR NEW.purchase_date >= last_purchase_date);
+    END;
+    CREATE INDEX IF NOT EXISTS idx_users_banned_last_purchase_date ON users(is_banned, last_purchase_date);
+    CREATE INDEX IF NOT EXISTS idx_users_banned_last_purchase_city ON users(is_banned, last_purchase_city);
+    -- <<< END ADDED >>>
+
+    -- One-off migration: idx_pending_deposits_purchase_created (is_purchase, created_at) serves every
+    -- is_purchase lookup, so the old single-column index only cost a write per pending_deposits change
+    DROP INDEX IF EXISTS idx_pending_deposits_is_purchase;
+"""
+
 def init_db():
     """Initializes the database schema."""
     try:
@@ -1326,6 +1499,22 @@ def init_db():
                 if "duplicate column name: broadcast_failed_count" in str(alter_e): pass
                 else: raise
 
+            # Last purchase date/city, kept on users so broadcast targeting never scans purchases
+            # (maintained by trg_purchases_user_last_purchase, created with the indices below)
+            try:
+                c.execute("ALTER TABLE users ADD COLUMN last_purchase_date TEXT DEFAULT NULL")
+                c.execute("ALTER TABLE users ADD COLUMN last_purchase_city TEXT DEFAULT NULL")
+                logger.info("Added 'last_purchase_date'/'last_purchase_city' columns to users table.")
+                # One-off backfill (purchases exists on upgraded DBs); MAX() makes SQLite take city from the latest row
+                if c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'purchases'").fetchone():
+                    c.execute("""UPDATE users SET last_purchase_date = lp.mx, last_purchase_city = lp.city
+                                 FROM (SELECT user_id, MAX(purchase_date) AS mx, city FROM purchases GROUP BY user_id) AS lp
+                                 WHERE users.user_id = lp.user_id""")
+                    logger.info(f"Backfilled last purchase for {c.rowcount} users.")
+            except sqlite3.OperationalError as alter_e:
+                if "duplicate column name: last_purchase_date" in str(alter_e): pass
+                else: raise
+
             # cities table
             c.execute('''CREATE TABLE IF NOT EXISTS cities (
                 id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL
@@ -1451,6 +1640,9 @@ def init_db():
             if 'basket_snapshot_json' not in pending_cols: c.execute("ALTER TABLE pending_deposits ADD COLUMN basket_snapshot_json TEXT DEFAULT NULL")
             if 'discount_code_used' not in pending_cols: c.execute("ALTER TABLE pending_deposits ADD COLUMN discount_code_used TEXT DEFAULT NULL")
             if 'bot_id' not in pending_cols: c.execute("ALTER TABLE pending_deposits ADD COLUMN bot_id TEXT DEFAULT NULL")
+            # Payment recovery backoff: attempts so far and earliest next attempt ('YYYY-MM-DD HH:MM:SS' UTC)
+            if 'retry_count' not in pending_cols: c.execute("ALTER TABLE pending_deposits ADD COLUMN retry_count INTEGER DEFAULT 0")
+            if 'next_retry_at' not in pending_cols: c.execute("ALTER TABLE pending_deposits ADD COLUMN next_retry_at TEXT DEFAULT NULL")
 
             # Admin Log table
             c.execute('''CREATE TABLE IF NOT EXISTS admin_log (
@@ -1573,29 +1765,9 @@ def init_db():
                 FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE
             )''')
 
-            # Create Indices
-            c.execute("CREATE INDEX IF NOT EXISTS idx_product_media_product_id ON product_media(product_id)")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_purchases_date ON purchases(purchase_date)")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id)")
-            c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_districts_city_name ON districts(city_id, name)")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_products_location_type ON products(city, district, product_type)")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_reviews_user ON reviews(user_id)")
-            c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_discount_code_unique ON discount_codes(code)")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_pending_deposits_user_id ON pending_deposits(user_id)")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_admin_log_timestamp ON admin_log(timestamp)")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_users_banned ON users(is_banned)")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_pending_deposits_is_purchase ON pending_deposits(is_purchase)")
-            c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_welcome_message_name ON welcome_messages(name)")
-            # <<< ADDED Indices for reseller >>>
-            c.execute("CREATE INDEX IF NOT EXISTS idx_users_is_reseller ON users(is_reseller)")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_reseller_discounts_user_id ON reseller_discounts(reseller_user_id)")
-            # <<< Solana payment indices for high concurrency >>>
-            c.execute("CREATE INDEX IF NOT EXISTS idx_solana_wallets_status ON solana_wallets(status)")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_solana_wallets_user_id ON solana_wallets(user_id)")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_solana_wallets_created_at ON solana_wallets(created_at)")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_payment_queue_status ON payment_queue(status)")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_payment_queue_user_id ON payment_queue(user_id)")
-            # <<< END ADDED >>>
+            # Create Indices, the last-purchase trigger and the index migration
+            # (one transaction: a single commit instead of one per statement)
+            c.executescript("BEGIN;\n" + _SCHEMA_INDEX_DDL + "\nCOMMIT;")
 
             conn.commit()
             
@@ -1606,9 +1778,13 @@ def init_db():
             c.execute("PRAGMA journal_mode=WAL;")
             c.execute(f"PRAGMA busy_timeout={_DB_BUSY_TIMEOUT};")
             c.execute("PRAGMA synchronous=NORMAL;")
-            c.execute("PRAGMA cache_size=10000;")
+            c.execute(f"PRAGMA cache_size=-{_DB_CACHE_SIZE_KIB};")
             wal_mode = c.execute("PRAGMA journal_mode;").fetchone()[0]
             logger.info(f"✅ Database WAL mode: {wal_mode} (high-concurrency enabled)")
+            # Fresh planner stats for the small, fast-churning pending_deposits table so the recovery scan and the
+            # health-check COUNTs stay on their covering (is_purchase, created_at) / partial created_at indexes
+            try: c.execute("ANALYZE pending_deposits")
+            except sqlite3.Error as analyze_e: logger.warning(f"ANALYZE pending_deposits failed: {analyze_e}")
             
             logger.info(f"Database schema at {DATABASE_PATH} initialized/verified successfully.")
     except sqlite3.Error as e:
@@ -1689,32 +1865,58 @@ def mark_queue_item_processed(payment_id: str, success: bool, error_message: str
 
 
 # --- Pending Deposit DB Helpers (Synchronous - Modified) ---
-def add_pending_deposit(payment_id: str, user_id: int, currency: str, target_eur_amount: float, expected_crypto_amount: float, is_purchase: bool = False, basket_snapshot: list | None = None, discount_code: str | None = None, bot_id: str | None = None):
-    basket_json = json.dumps(basket_snapshot) if basket_snapshot else None
+def add_pending_deposits_batch(rows: list[tuple]) -> bool:
+    """
+    Inserts several pending deposits in ONE transaction (single commit/fsync).
+    Each row follows add_pending_deposit's argument order:
+    (payment_id, user_id, currency, target_eur_amount, expected_crypto_amount,
+     is_purchase, basket_snapshot, discount_code, bot_id)
+    All-or-nothing: a duplicate payment_id rolls back the whole batch.
+    """
+    if not rows:
+        return True
+    created_at = datetime.now(timezone.utc).isoformat()
+    insert_data = [
+        (payment_id, user_id, currency.lower(), target_eur_amount, expected_crypto_amount, created_at,
+         1 if is_purchase else 0, json.dumps(basket_snapshot) if basket_snapshot else None, discount_code, bot_id)
+        for (payment_id, user_id, currency, target_eur_amount, expected_crypto_amount,
+             is_purchase, basket_snapshot, discount_code, bot_id) in rows
+    ]
+    conn = None
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("""
-                INSERT INTO pending_deposits (
-                    payment_id, user_id, currency, target_eur_amount,
-                    expected_crypto_amount, created_at, is_purchase,
-                    basket_snapshot_json, discount_code_used, bot_id
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                payment_id, user_id, currency.lower(), target_eur_amount,
-                expected_crypto_amount, datetime.now(timezone.utc).isoformat(),
-                1 if is_purchase else 0, basket_json, discount_code, bot_id
-                ))
-            conn.commit()
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("BEGIN")
+        c.executemany("""
+            INSERT INTO pending_deposits (
+                payment_id, user_id, currency, target_eur_amount,
+                expected_crypto_amount, created_at, is_purchase,
+                basket_snapshot_json, discount_code_used, bot_id
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, insert_data)
+        conn.commit()
+        for (payment_id, user_id, currency, target_eur_amount, expected_crypto_amount,
+             is_purchase, basket_snapshot, discount_code, bot_id) in rows:
             log_type = "direct purchase" if is_purchase else "refill"
             logger.info(f"Added pending {log_type} deposit {payment_id} for user {user_id} ({target_eur_amount:.2f} EUR / exp: {expected_crypto_amount} {currency}). Basket items: {len(basket_snapshot) if basket_snapshot else 0}. Bot: {bot_id}")
-            return True
+        return True
     except sqlite3.IntegrityError:
-        logger.warning(f"Attempted to add duplicate pending deposit ID: {payment_id}")
+        logger.warning(f"Attempted to add duplicate pending deposit ID in batch: {[row[0] for row in rows]}")
+        if conn and conn.in_transaction: conn.rollback()
         return False
     except sqlite3.Error as e:
-        logger.error(f"DB error adding pending deposit {payment_id} for user {user_id}: {e}", exc_info=True)
+        logger.error(f"DB error adding {len(rows)} pending deposit(s): {e}", exc_info=True)
+        if conn and conn.in_transaction: conn.rollback()
         return False
+    finally:
+        if conn: conn.close()
+
+def add_pending_deposit(payment_id: str, user_id: int, currency: str, target_eur_amount: float, expected_crypto_amount: float, is_purchase: bool = False, basket_snapshot: list | None = None, discount_code: str | None = None, bot_id: str | None = None):
+    """Single-row wrapper around add_pending_deposits_batch."""
+    return add_pending_deposits_batch([(
+        payment_id, user_id, currency, target_eur_amount, expected_crypto_amount,
+        is_purchase, basket_snapshot, discount_code, bot_id
+    )])
 
 def get_pending_deposit(payment_id: str):
     try:
@@ -1750,6 +1952,23 @@ def get_pending_deposit(payment_id: str):
         return None
 
 # --- HELPER TO UNRESERVE ITEMS (Synchronous) ---
+_RELEASE_BATCH_SIZE = 400 # (id, count) pairs per statement; 2 params each stays far below SQLite's variable limit
+
+def _release_product_reservations(cursor: sqlite3.Cursor, counts: dict[int, int]):
+    """Decrements products.reserved by counts[product_id] using one UPDATE ... FROM per batch.
+    Must be called inside the caller's transaction."""
+    pairs = list(counts.items())
+    for start in range(0, len(pairs), _RELEASE_BATCH_SIZE):
+        batch = pairs[start:start + _RELEASE_BATCH_SIZE]
+        values_sql = ','.join(['(?,?)'] * len(batch))
+        params = [value for pair in batch for value in pair]
+        cursor.execute(
+            f"WITH released(pid, cnt) AS (VALUES {values_sql}) "
+            "UPDATE products SET reserved = MAX(0, products.reserved - released.cnt) "
+            "FROM released WHERE products.id = released.pid",
+            params
+        )
+
 def _unreserve_basket_items(basket_snapshot: list | None):
     """Helper to decrement reserved counts for items in a snapshot."""
     if not basket_snapshot:
@@ -1764,8 +1983,7 @@ def _unreserve_basket_items(basket_snapshot: list | None):
         conn = get_db_connection()
         c = conn.cursor()
         c.execute("BEGIN")
-        decrement_data = [(count, pid) for pid, count in product_ids_to_release_counts.items()]
-        c.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
+        _release_product_reservations(c, product_ids_to_release_counts)
         conn.commit()
         total_released = sum(product_ids_to_release_counts.values())
         logger.info(f"Un-reserved {total_released} items due to failed/expired/cancelled payment.") # General log message
@@ -1775,6 +1993,48 @@ def _unreserve_basket_items(basket_snapshot: list | None):
     finally:
         if conn: conn.close()
 
+# Triggers that mean the payment completed - reserved items are NOT released for these
+_SUCCESSFUL_PAYMENT_TRIGGERS = frozenset({'purchase_success', 'refill_success', 'crypto_payment_success', 'refill_payment_success', 'recovery_success'})
+_PENDING_DELETE_BATCH_SIZE = 500 # payment_ids per IN (...) list; stays under SQLite's default 999-variable limit
+
+def _remove_pending_deposits_bulk(payment_ids: list[str], trigger: str = "unknown", basket_snapshots: dict[str, list] | None = None) -> set[str]:
+    """
+    Deletes many pending deposits with DELETE ... WHERE payment_id IN (...) in ONE transaction.
+    If basket_snapshots (payment_id -> snapshot) is given and the trigger is not a success trigger,
+    the reservations of the rows that were actually deleted are released in that same transaction
+    (rows already removed elsewhere, e.g. by a late success webhook, are not released twice).
+    Returns the set of payment_ids that were deleted. Raises sqlite3.Error (rolled back).
+    """
+    deleted_ids: set[str] = set()
+    if not payment_ids:
+        return deleted_ids
+    with db_pool.acquire_writer() as conn:
+        c = conn.cursor()
+        c.row_factory = None
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for start in range(0, len(payment_ids), _PENDING_DELETE_BATCH_SIZE):
+                batch = payment_ids[start:start + _PENDING_DELETE_BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch))
+                c.execute(f"SELECT payment_id FROM pending_deposits WHERE payment_id IN ({placeholders})", batch)
+                deleted_ids.update(payment_id for (payment_id,) in c.fetchall())
+                c.execute(f"DELETE FROM pending_deposits WHERE payment_id IN ({placeholders})", batch)
+            if basket_snapshots and trigger not in _SUCCESSFUL_PAYMENT_TRIGGERS:
+                release_counts = Counter(
+                    item['product_id']
+                    for payment_id in deleted_ids
+                    for item in (basket_snapshots.get(payment_id) or ()) if 'product_id' in item
+                )
+                if release_counts:
+                    _release_product_reservations(c, release_counts)
+                    logger.info(f"Un-reserved {sum(release_counts.values())} items from {len(deleted_ids)} removed pending deposits (Trigger: {trigger}).")
+            conn.commit()
+        except sqlite3.Error:
+            if conn.in_transaction: conn.rollback()
+            raise
+    logger.info(f"Removed {len(deleted_ids)}/{len(payment_ids)} pending deposit records in bulk (Trigger: {trigger})")
+    return deleted_ids
+
 # --- REMOVE PENDING DEPOSIT (Modified Trigger Logic) ---
 def remove_pending_deposit(payment_id: str, trigger: str = "unknown"): # Added trigger for logging
     pending_info = get_pending_deposit(payment_id) # Get info *before* deleting
@@ -1797,9 +2057,8 @@ def remove_pending_deposit(payment_id: str, trigger: str = "unknown"): # Added t
 
     # --- MODIFIED Condition for Un-reserving ---
     # Un-reserve if deletion was successful, it was a purchase, AND the trigger indicates non-success
-    # IMPORTANT: Include ALL triggers that indicate successful payment completion
-    successful_triggers = ['purchase_success', 'refill_success', 'crypto_payment_success', 'refill_payment_success', 'recovery_success']
-    if deleted and pending_info and pending_info.get('is_purchase') == 1 and trigger not in successful_triggers:
+    # IMPORTANT: _SUCCESSFUL_PAYMENT_TRIGGERS must include ALL triggers that indicate successful payment completion
+    if deleted and pending_info and pending_info.get('is_purchase') == 1 and trigger not in _SUCCESSFUL_PAYMENT_TRIGGERS:
         log_reason = f"payment {payment_id} failure/expiry/cancellation (Trigger: {trigger})"
         logger.info(f"Payment was a purchase that did not succeed or was cancelled. Attempting to un-reserve items from snapshot ({log_reason}).")
         _unreserve_basket_items(pending_info.get('basket_snapshot'))
@@ -1903,35 +2162,23 @@ async def is_user_banned(user_id: int) -> bool:
         bool: True if user is banned, False if not banned or if user doesn't exist
     """
     # Skip ban check for admins
-    if user_id == ADMIN_ID or user_id in SECONDARY_ADMIN_IDS:
+    if user_id == ADMIN_ID or user_id in _SECONDARY_ADMIN_ID_SET:
         return False
     
+    # Lock contention is handled inside SQLite by the connection's PRAGMA busy_timeout
+    # (see get_db_connection), so a single query is enough - no Python-level retry loop.
     conn = None
-    max_retries = 3
-    retry_delay = 0.1  # 100ms
-    
-    for attempt in range(max_retries):
-        try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            c.execute("SELECT is_banned FROM users WHERE user_id = ?", (user_id,))
-            res = c.fetchone()
-            return res and res['is_banned'] == 1
-        except sqlite3.Error as e:
-            if "database is locked" in str(e).lower() and attempt < max_retries - 1:
-                logger.warning(f"Database locked for ban check (attempt {attempt + 1}/{max_retries}), retrying in {retry_delay}s...")
-                await asyncio.sleep(retry_delay)
-                retry_delay *= 2  # Exponential backoff
-                continue
-            else:
-                logger.error(f"DB error checking ban status for user {user_id}: {e}")
-                return False  # Default to not banned if there's a DB error
-        finally:
-            if conn:
-                conn.close()
-                conn = None
-    
-    return False  # Default to not banned if all retries failed
+    try:
+        conn = get_db_connection()
+        c = conn.cursor()
+        c.execute("SELECT is_banned FROM users WHERE user_id = ?", (user_id,))
+        res = c.fetchone()
+        return bool(res and res['is_banned'] == 1)
+    except sqlite3.Error as e:
+        logger.error(f"DB error checking ban status for user {user_id}: {e}")
+        return False  # Default to not banned if there's a DB error
+    finally:
+        if conn: conn.close()
 
 
 # --- Utility Functions ---
@@ -1939,36 +2186,50 @@ def _get_lang_data(context: ContextTypes.DEFAULT_TYPE) -> tuple[str, dict]:
     """Gets the current language code and corresponding language data dictionary.
     Safely handles None context or None user_data (from background jobs).
     """
-    lang = "en"  # Default
-    if context is not None and hasattr(context, 'user_data') and context.user_data is not None:
+    try:
         lang = context.user_data.get("lang", "en")
-    # Uses LANGUAGES dict defined above in this file
-    lang_data = LANGUAGES.get(lang, LANGUAGES['en'])
-    if lang not in LANGUAGES:
+    except AttributeError:
+        lang = "en"  # None context, context without user_data, or user_data is None
+    # Uses LANGUAGES dict defined above in this file - single lookup on the hot path
+    lang_data = LANGUAGES.get(lang)
+    if lang_data is None:
         logger.warning(f"_get_lang_data: Language '{lang}' not found in LANGUAGES dict. Falling back to 'en'.")
-        lang = 'en' # Ensure lang variable reflects the fallback
+        lang, lang_data = 'en', LANGUAGES['en'] # Ensure lang variable reflects the fallback
     return lang, lang_data
 
+@lru_cache(maxsize=4096)
+def _format_currency_str(value_str: str) -> str:
+    """Cached Decimal formatting keyed on the string form (prices repeat a lot)."""
+    return f"{Decimal(value_str):.2f}"
+
+@lru_cache(maxsize=1024)
+def _format_percentage_str(value_str: str) -> str:
+    return f"{Decimal(value_str):.1f}%"
+
 def format_currency(value):
-    try: return f"{Decimal(str(value)):.2f}"
+    try: return _format_currency_str(str(value))
     except (ValueError, TypeError): logger.warning(f"Could format currency {value}"); return "0.00"
 
 def format_discount_value(dtype, value):
     try:
-        if dtype == 'percentage': return f"{Decimal(str(value)):.1f}%"
+        if dtype == 'percentage': return _format_percentage_str(str(value))
         elif dtype == 'fixed': return f"{format_currency(value)} EUR"
         return str(value)
     except (ValueError, TypeError): logger.warning(f"Could not format discount {dtype} {value}"); return "N/A"
 
+# Progress bars for 0..5 filled cells, and filled-cell count for purchases 0..10
+# (thresholds 0, 2, 5, 8, 10). Both are built once at import.
+_PROGRESS_BARS = tuple('[' + '\U0001F7E9' * filled + '\u2B1C' * (5 - filled) + ']' for filled in range(6))
+_PROGRESS_FILLED_LUT = tuple(sum(1 for t in (0, 2, 5, 8, 10) if p >= t) for p in range(11))
+
 def get_progress_bar(purchases):
     """Returns emoji progress bar based on purchase count."""
     try:
         p_int = int(purchases)
-        thresholds = [0, 2, 5, 8, 10]
-        filled = min(sum(1 for t in thresholds if p_int >= t), 5)
-        return '[' + '\U0001F7E9' * filled + '\u2B1C' * (5 - filled) + ']'
+        if p_int < 0: return _PROGRESS_BARS[0]
+        return _PROGRESS_BARS[_PROGRESS_FILLED_LUT[min(p_int, 10)]]
     except (ValueError, TypeError): 
-        return '[\u2B1C\u2B1C\u2B1C\u2B1C\u2B1C]'
+        return _PROGRESS_BARS[0]
 
 
 # ============================================================================
@@ -1981,45 +2242,159 @@ class TelegramRateLimiter:
     Ensures we stay within Telegram's limits:
     - Global: 30 msgs/sec (we use 25 for safety)
     - Per-chat: 20 msgs/sec (we use 16 for safety)
+
+    Token buckets. The global bucket has no lock: a sender reserves its token
+    (letting the bucket go negative) in one synchronous step - atomic on the
+    event loop since there is no await in between - then sleeps off the debt.
+    Only the per-chat lock remains, so sends to one chat keep their order
+    while different chats proceed in parallel.
+
+    Per-chat state is an LRU capped at MAX_TRACKED_CHATS so broadcasts to many
+    users don't pin a lock + bucket per chat forever.
     """
-    GLOBAL_MIN_INTERVAL = 0.04  # 25 msgs/sec (83% of 30 limit)
-    CHAT_MIN_INTERVAL = 0.06     # 16 msgs/sec (80% of 20 limit)
+    # Rates bound the long-run throughput; capacities let queued messages leave
+    # back-to-back in a short burst up to Telegram's per-second limits.
+    GLOBAL_RATE = 25.0      # 25 msgs/sec refill (83% of 30 limit)
+    GLOBAL_CAPACITY = 30.0  # burst size
+    CHAT_RATE = 16.0        # 16 msgs/sec refill (80% of 20 limit)
+    CHAT_CAPACITY = 20.0    # burst size
+    MAX_TRACKED_CHATS = 10000
+    _now = time.monotonic  # Monotonic: NTP wall-clock adjustments can't produce negative intervals
     
     def __init__(self):
-        self._global_lock = asyncio.Lock()
-        self._chat_locks = {}
-        self._last_global_send = 0.0
-        self._last_chat_send = {}
+        self._global_tokens = self.GLOBAL_CAPACITY
+        self._global_last_refill = 0.0
+        self._chats = OrderedDict()  # {chat_id: [lock, tokens, last_refill]}, least recently used first
+
+    def _reserve_global(self, now: float) -> float:
+        """Takes one global token (possibly into debt). Returns seconds to wait."""
+        tokens = min(self.GLOBAL_CAPACITY, self._global_tokens + (now - self._global_last_refill) * self.GLOBAL_RATE) - 1
+        self._global_tokens = tokens
+        self._global_last_refill = now
+        return -tokens / self.GLOBAL_RATE if tokens < 0 else 0.0
+
+    def _get_chat_state(self, chat_id: int, now: float) -> list:
+        """Returns (creating if needed) chat_id's state and marks it most recently used."""
+        state = self._chats.get(chat_id)
+        if state is not None:
+            self._chats.move_to_end(chat_id)
+            return state
+        state = self._chats[chat_id] = [asyncio.Lock(), self.CHAT_CAPACITY, now]
+        # Evict idle chats; one that is mid-send (lock held) stops the sweep
+        while len(self._chats) > self.MAX_TRACKED_CHATS:
+            oldest_id, oldest_state = next(iter(self._chats.items()))
+            if oldest_state[0].locked():
+                self._chats.move_to_end(oldest_id)
+                break
+            del self._chats[oldest_id]
+        return state
+
+    def _reserve_chat(self, state: list, now: float) -> float:
+        """Takes one token from a chat bucket (possibly into debt). Returns seconds to wait."""
+        tokens = min(self.CHAT_CAPACITY, state[1] + (now - state[2]) * self.CHAT_RATE) - 1
+        state[1] = tokens
+        state[2] = now
+        return -tokens / self.CHAT_RATE if tokens < 0 else 0.0
     
     async def acquire(self, chat_id: int):
         """Acquire permission to send to chat_id. Waits if needed."""
-        import time
-        current_time = time.time()
-        
-        # Global rate limit
-        async with self._global_lock:
-            time_since_last = current_time - self._last_global_send
-            if time_since_last < self.GLOBAL_MIN_INTERVAL:
-                wait_time = self.GLOBAL_MIN_INTERVAL - time_since_last
-                await asyncio.sleep(wait_time)
-            self._last_global_send = time.time()
-        
-        # Per-chat rate limit
-        if chat_id not in self._chat_locks:
-            self._chat_locks[chat_id] = asyncio.Lock()
+        state = self._get_chat_state(chat_id, self._now())
         
-        async with self._chat_locks[chat_id]:
-            last_send = self._last_chat_send.get(chat_id, 0.0)
-            time_since_last = time.time() - last_send
-            if time_since_last < self.CHAT_MIN_INTERVAL:
-                wait_time = self.CHAT_MIN_INTERVAL - time_since_last
+        # Per-chat lock serialises sends within ONE chat only
+        async with state[0]:
+            now = self._now()  # Once per acquire - we may have waited for the chat lock
+            wait_time = max(self._reserve_global(now), self._reserve_chat(state, now))
+            if wait_time > 0:
                 await asyncio.sleep(wait_time)
-            self._last_chat_send[chat_id] = time.time()
 
 # Global rate limiter instance
 _telegram_rate_limiter = TelegramRateLimiter()
 
 
+# Error phrases that make a BadRequest permanent - retrying won't help.
+# Each set is folded into one case-insensitive alternation so a failure is scanned once.
+def _compile_phrase_alternation(phrases) -> re.Pattern:
+    return re.compile('|'.join(map(re.escape, sorted(phrases))), re.IGNORECASE)
+
+_UNRECOVERABLE_MESSAGE_ERRORS = _compile_phrase_alternation({"chat not found", "bot was blocked", "user is deactivated", "message is too long"})
+_UNRECOVERABLE_MEDIA_ERRORS = _compile_phrase_alternation({"chat not found", "bot was blocked", "user is deactivated", "wrong file identifier"})
+_MAX_SEND_BACKOFF = 30.0  # Cap for a single backoff sleep (seconds)
+
+
+def _backoff_delay(base: float, attempt: int) -> float:
+    """Exponential backoff with jitter: base * 2**attempt (capped), scaled by 0.5x-1.5x.
+    The jitter keeps senders that failed together from retrying in lockstep."""
+    return min(_MAX_SEND_BACKOFF, base * (2 ** attempt)) * (0.5 + random.random())
+
+
+# --- Send error classification: each handler returns (action, sleep_seconds) ---
+_SEND_RETRY = "retry"
+_SEND_ABORT = "abort"
+MAX_RETRY_AFTER = 120  # Longer server-requested waits are clamped to this instead of giving up
+
+def _on_send_bad_request(e, attempt, base_backoff, unrecoverable_re):
+    if unrecoverable_re.search(str(e)):
+        return _SEND_ABORT, 0.0 # Unrecoverable errors - don't retry
+    return _SEND_RETRY, _backoff_delay(base_backoff, attempt) # ~1s, 2s, 4s, 8s, 16s with jitter
+
+def _on_send_retry_after(e, attempt, base_backoff, unrecoverable_re):
+    # 2 second buffer, clamped, plus jitter so 429-victims don't resync
+    return _SEND_RETRY, min(e.retry_after + 2, MAX_RETRY_AFTER) + random.uniform(0, 2)
+
+def _on_send_network_error(e, attempt, base_backoff, unrecoverable_re):
+    return _SEND_RETRY, _backoff_delay(2 * base_backoff, attempt) # ~2s, 4s, 8s, 16s, 30s with jitter
+
+def _on_send_forbidden(e, attempt, base_backoff, unrecoverable_re):
+    return _SEND_ABORT, 0.0 # User may have blocked the bot
+
+def _on_send_unexpected(e, attempt, base_backoff, unrecoverable_re):
+    return _SEND_RETRY, _backoff_delay(base_backoff, attempt)
+
+# Looked up along type(e).__mro__, so subclasses (e.g. TimedOut -> NetworkError) resolve to the nearest handler
+_SEND_ERROR_HANDLERS = {
+    telegram_error.BadRequest: _on_send_bad_request,
+    telegram_error.RetryAfter: _on_send_retry_after,
+    telegram_error.NetworkError: _on_send_network_error,
+    telegram_error.Forbidden: _on_send_forbidden,
+    Exception: _on_send_unexpected,
+}
+
+
+async def _send_with_retry(send_factory, chat_id: int, what: str, unrecoverable_re: re.Pattern, max_retries: int, base_backoff: float = 1.0):
+    """
+    Shared retry ladder for the send_*_with_retry helpers.
+    - send_factory: zero-arg callable returning a NEW send coroutine for each attempt
+    - what: label used in log messages ("message", "photo", "media group", ...)
+    Returns the send result, or None on permanent failure.
+    """
+    for attempt in range(max_retries):
+        try:
+            # Rate limit BEFORE sending to prevent 429 errors
+            await _telegram_rate_limiter.acquire(chat_id)
+            
+            result = await send_factory()
+            # Log success for debugging
+            if attempt > 0:
+                logger.info(f"✅ Sent {what} to {chat_id} after {attempt + 1} attempts")
+            return result
+        except Exception as e:
+            handler = next(_SEND_ERROR_HANDLERS[cls] for cls in type(e).__mro__ if cls in _SEND_ERROR_HANDLERS)
+            action, delay = handler(e, attempt, base_backoff, unrecoverable_re)
+            unexpected = handler is _on_send_unexpected
+            logger.log(logging.ERROR if unexpected else logging.WARNING,
+                       f"{type(e).__name__} sending {what} to {chat_id} (Attempt {attempt+1}/{max_retries}): {e}", exc_info=unexpected)
+            if action == _SEND_ABORT:
+                logger.error(f"Unrecoverable {type(e).__name__} sending {what} to {chat_id}. Aborting retries.")
+                return None
+            if attempt < max_retries - 1:
+                logger.debug(f"Retrying {what} to {chat_id} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                logger.error(f"Max retries reached for {type(e).__name__} sending {what} to {chat_id}: {e}")
+    logger.error(f"❌ Failed to send {what} to {chat_id} after {max_retries} attempts")
+    return None
+
+
 async def send_message_with_retry(
     bot: Bot,
     chat_id: int,
@@ -2036,61 +2411,22 @@ async def send_message_with_retry(
     - 5 retries with exponential backoff
     - Returns None only for permanent failures
     """
-    for attempt in range(max_retries):
-        try:
-            # Rate limit BEFORE sending to prevent 429 errors
-            await _telegram_rate_limiter.acquire(chat_id)
-            
-            result = await bot.send_message(
-                chat_id=chat_id, text=text, reply_markup=reply_markup,
-                parse_mode=parse_mode, disable_web_page_preview=disable_web_page_preview
-            )
-            # Log success for debugging
-            if attempt > 0:
-                logger.info(f"✅ Message sent to {chat_id} after {attempt + 1} attempts")
-            return result
-        except telegram_error.BadRequest as e:
-            error_lower = str(e).lower()
-            logger.warning(f"BadRequest sending to {chat_id} (Attempt {attempt+1}/{max_retries}): {e}")
-            # Unrecoverable errors - don't retry
-            if any(phrase in error_lower for phrase in ["chat not found", "bot was blocked", "user is deactivated", "message is too long"]):
-                logger.error(f"Unrecoverable BadRequest sending to {chat_id}: {e}. Aborting retries.")
-                return None
-            if attempt < max_retries - 1: 
-                await asyncio.sleep(1 * (2 ** attempt))  # Exponential backoff: 1s, 2s, 4s, 8s, 16s
-                continue
-            else: 
-                logger.error(f"Max retries reached for BadRequest sending to {chat_id}: {e}")
-                break
-        except telegram_error.RetryAfter as e:
-            retry_seconds = e.retry_after + 2  # Add 2 second buffer
-            logger.warning(f"⏳ Rate limit (429) for chat {chat_id}. Retrying after {retry_seconds}s")
-            if retry_seconds > 120:  # Increased from 60 to 120 seconds
-                logger.error(f"RetryAfter requested > 120s ({retry_seconds}s). Aborting for chat {chat_id}.")
-                return None
-            await asyncio.sleep(retry_seconds)
-            continue  # Don't count as attempt
-        except telegram_error.NetworkError as e:
-            logger.warning(f"NetworkError sending to {chat_id} (Attempt {attempt+1}/{max_retries}): {e}")
-            if attempt < max_retries - 1: 
-                await asyncio.sleep(2 * (2 ** attempt))  # Exponential backoff: 2s, 4s, 8s, 16s, 32s
-                continue
-            else: 
-                logger.error(f"Max retries reached for NetworkError sending to {chat_id}: {e}")
-                break
-        except telegram_error.Forbidden: 
-            logger.warning(f"Forbidden error sending to {chat_id}. User may have blocked the bot. Aborting.")
-            return None
-        except Exception as e:
-            logger.error(f"Unexpected error sending message to {chat_id} (Attempt {attempt+1}/{max_retries}): {e}", exc_info=True)
-            if attempt < max_retries - 1: 
-                await asyncio.sleep(1 * (2 ** attempt))
-                continue
-            else: 
-                logger.error(f"Max retries reached after unexpected error sending to {chat_id}: {e}")
-                break
-    logger.error(f"❌ Failed to send message to {chat_id} after {max_retries} attempts")
-    return None
+    return await _send_with_retry(
+        lambda: bot.send_message(
+            chat_id=chat_id, text=text, reply_markup=reply_markup,
+            parse_mode=parse_mode, disable_web_page_preview=disable_web_page_preview
+        ),
+        chat_id, "message", _UNRECOVERABLE_MESSAGE_ERRORS, max_retries
+    )
+
+
+# media_type -> (Bot method name, media keyword argument)
+_MEDIA_SENDERS = {
+    'photo': ('send_photo', 'photo'),
+    'video': ('send_video', 'video'),
+    'animation': ('send_animation', 'animation'),
+    'document': ('send_document', 'document'),
+}
 
 
 async def send_media_with_retry(
@@ -2107,65 +2443,16 @@ async def send_media_with_retry(
     Supports: photo, video, animation, document
     Returns: Message object on success, None on failure
     """
-    for attempt in range(max_retries):
-        try:
-            # Rate limit BEFORE sending
-            await _telegram_rate_limiter.acquire(chat_id)
-            
-            # Send based on media type
-            if media_type == 'photo':
-                return await bot.send_photo(chat_id=chat_id, photo=media, caption=caption, parse_mode=parse_mode)
-            elif media_type == 'video':
-                return await bot.send_video(chat_id=chat_id, video=media, caption=caption, parse_mode=parse_mode)
-            elif media_type == 'animation':
-                return await bot.send_animation(chat_id=chat_id, animation=media, caption=caption, parse_mode=parse_mode)
-            elif media_type == 'document':
-                return await bot.send_document(chat_id=chat_id, document=media, caption=caption, parse_mode=parse_mode)
-            else:
-                logger.error(f"Unsupported media_type: {media_type}")
-                return None
-                
-        except telegram_error.BadRequest as e:
-            error_lower = str(e).lower()
-            logger.warning(f"BadRequest sending {media_type} to {chat_id} (Attempt {attempt+1}/{max_retries}): {e}")
-            if any(phrase in error_lower for phrase in ["chat not found", "bot was blocked", "user is deactivated", "wrong file identifier"]):
-                logger.error(f"Unrecoverable BadRequest sending {media_type} to {chat_id}: {e}")
-                return None
-            if attempt < max_retries - 1: 
-                await asyncio.sleep(1 * (2 ** attempt))
-                continue
-            else: 
-                logger.error(f"Max retries reached for BadRequest sending {media_type} to {chat_id}")
-                break
-        except telegram_error.RetryAfter as e:
-            retry_seconds = e.retry_after + 2
-            logger.warning(f"⏳ Rate limit (429) for chat {chat_id}. Retrying {media_type} after {retry_seconds}s")
-            if retry_seconds > 120:
-                logger.error(f"RetryAfter > 120s for {media_type} to {chat_id}. Aborting.")
-                return None
-            await asyncio.sleep(retry_seconds)
-            continue
-        except telegram_error.NetworkError as e:
-            logger.warning(f"NetworkError sending {media_type} to {chat_id} (Attempt {attempt+1}/{max_retries}): {e}")
-            if attempt < max_retries - 1: 
-                await asyncio.sleep(2 * (2 ** attempt))
-                continue
-            else: 
-                logger.error(f"Max retries reached for NetworkError sending {media_type} to {chat_id}")
-                break
-        except telegram_error.Forbidden: 
-            logger.warning(f"Forbidden error sending {media_type} to {chat_id}. User blocked bot.")
-            return None
-        except Exception as e:
-            logger.error(f"Unexpected error sending {media_type} to {chat_id} (Attempt {attempt+1}/{max_retries}): {e}", exc_info=True)
-            if attempt < max_retries - 1: 
-                await asyncio.sleep(1 * (2 ** attempt))
-                continue
-            else: 
-                logger.error(f"Max retries reached sending {media_type} to {chat_id}")
-                break
-    logger.error(f"❌ Failed to send {media_type} to {chat_id} after {max_retries} attempts")
-    return None
+    sender = _MEDIA_SENDERS.get(media_type)
+    if not sender:
+        logger.error(f"Unsupported media_type: {media_type}")
+        return None
+    method_name, media_kwarg = sender
+    send_method = getattr(bot, method_name)
+    return await _send_with_retry(
+        lambda: send_method(chat_id=chat_id, caption=caption, parse_mode=parse_mode, **{media_kwarg: media}),
+        chat_id, media_type, _UNRECOVERABLE_MEDIA_ERRORS, max_retries
+    )
 
 
 async def send_media_group_with_retry(
@@ -2189,121 +2476,112 @@ async def send_media_group_with_retry(
         logger.error(f"Media group too large ({len(media)} items) for chat {chat_id}. Max 10 items.")
         return None
     
-    for attempt in range(max_retries):
-        try:
-            # Rate limit BEFORE sending
-            await _telegram_rate_limiter.acquire(chat_id)
-            
-            return await bot.send_media_group(chat_id=chat_id, media=media)
-                
-        except telegram_error.BadRequest as e:
-            error_lower = str(e).lower()
-            logger.warning(f"BadRequest sending media group to {chat_id} (Attempt {attempt+1}/{max_retries}): {e}")
-            if any(phrase in error_lower for phrase in ["chat not found", "bot was blocked", "user is deactivated", "wrong file identifier"]):
-                logger.error(f"Unrecoverable BadRequest sending media group to {chat_id}: {e}")
-                return None
-            if attempt < max_retries - 1: 
-                await asyncio.sleep(1 * (2 ** attempt))
-                continue
-            else: 
-                logger.error(f"Max retries reached for BadRequest sending media group to {chat_id}")
-                break
-        except telegram_error.RetryAfter as e:
-            retry_seconds = e.retry_after + 2
-            logger.warning(f"⏳ Rate limit (429) for chat {chat_id}. Retrying media group after {retry_seconds}s")
-            if retry_seconds > 120:
-                logger.error(f"RetryAfter > 120s for media group to {chat_id}. Aborting.")
-                return None
-            await asyncio.sleep(retry_seconds)
-            continue
-        except telegram_error.NetworkError as e:
-            logger.warning(f"NetworkError sending media group to {chat_id} (Attempt {attempt+1}/{max_retries}): {e}")
-            if attempt < max_retries - 1: 
-                await asyncio.sleep(2 * (2 ** attempt))
-                continue
-            else: 
-                logger.error(f"Max retries reached for NetworkError sending media group to {chat_id}")
-                break
-        except telegram_error.Forbidden: 
-            logger.warning(f"Forbidden error sending media group to {chat_id}. User blocked bot.")
-            return None
-        except Exception as e:
-            logger.error(f"Unexpected error sending media group to {chat_id} (Attempt {attempt+1}/{max_retries}): {e}", exc_info=True)
-            if attempt < max_retries - 1: 
-                await asyncio.sleep(1 * (2 ** attempt))
-                continue
-            else: 
-                logger.error(f"Max retries reached sending media group to {chat_id}")
-                break
-    logger.error(f"❌ Failed to send media group ({len(media)} items) to {chat_id} after {max_retries} attempts")
-    return None
+    return await _send_with_retry(
+        lambda: bot.send_media_group(chat_id=chat_id, media=media),
+        chat_id, f"media group ({len(media)} items)", _UNRECOVERABLE_MEDIA_ERRORS, max_retries
+    )
+
+
+def _day_start(d):
+    return datetime(d.year, d.month, d.day, tzinfo=timezone.utc)
+
+def _day_end(d):
+    return datetime(d.year, d.month, d.day, 23, 59, 59, 999999, tzinfo=timezone.utc)
 
+def _last_week_range(d):
+    start_of_this_week = d - timedelta(days=d.weekday())
+    return _day_start(start_of_this_week - timedelta(days=7)), _day_end(start_of_this_week - timedelta(days=1))
+
+def _last_month_range(d):
+    end_of_last_month = d.replace(day=1) - timedelta(days=1)
+    return _day_start(end_of_last_month.replace(day=1)), _day_end(end_of_last_month)
+
+# period_key -> callable(today: date) -> (start, end); end None means "now"
+_DATE_RANGE_BUILDERS = {
+    'today': lambda d: (_day_start(d), None),
+    'yesterday': lambda d: (_day_start(d - timedelta(days=1)), _day_end(d - timedelta(days=1))),
+    'week': lambda d: (_day_start(d - timedelta(days=d.weekday())), None),
+    'last_week': _last_week_range,
+    'month': lambda d: (_day_start(d.replace(day=1)), None),
+    'last_month': _last_month_range,
+    'year': lambda d: (_day_start(d.replace(month=1, day=1)), None),
+}
+
+@lru_cache(maxsize=32)
+def _date_range_bounds(period_key, today):
+    """ISO bounds for period_key; they only depend on the (UTC) date, so cache per day."""
+    start, end = _DATE_RANGE_BUILDERS[period_key](today)
+    return start.isoformat(), end.isoformat() if end else None
 
 def get_date_range(period_key):
+    builder = _DATE_RANGE_BUILDERS.get(period_key)
+    if builder is None: return None, None
     now = datetime.now(timezone.utc) # Use UTC now
     try:
-        if period_key == 'today': start = now.replace(hour=0, minute=0, second=0, microsecond=0); end = now
-        elif period_key == 'yesterday': yesterday = now - timedelta(days=1); start = yesterday.replace(hour=0, minute=0, second=0, microsecond=0); end = yesterday.replace(hour=23, minute=59, second=59, microsecond=999999)
-        elif period_key == 'week': start = (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0); end = now
-        elif period_key == 'last_week': start_of_this_week = (now - timedelta(days=now.weekday())).replace(hour=0, minute=0, second=0, microsecond=0); end_of_last_week = start_of_this_week - timedelta(microseconds=1); start = (end_of_last_week - timedelta(days=end_of_last_week.weekday())).replace(hour=0, minute=0, second=0, microsecond=0); end = end_of_last_week.replace(hour=23, minute=59, second=59, microsecond=999999)
-        elif period_key == 'month': start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0); end = now
-        elif period_key == 'last_month': first_of_this_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0); end_of_last_month = first_of_this_month - timedelta(microseconds=1); start = end_of_last_month.replace(day=1, hour=0, minute=0, second=0, microsecond=0); end = end_of_last_month.replace(hour=23, minute=59, second=59, microsecond=999999)
-        elif period_key == 'year': start = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0); end = now
-        else: return None, None
-        # Return ISO format strings (already in UTC)
-        return start.isoformat(), end.isoformat()
+        start_iso, end_iso = _date_range_bounds(period_key, now.date())
+        # Return ISO format strings (already in UTC); open-ended periods end at 'now'
+        return start_iso, end_iso or now.isoformat()
     except Exception as e: logger.error(f"Error calculating date range for '{period_key}': {e}"); return None, None
 
 
+# Purchase counts at which each next status starts; _USER_STATUS_LABELS has one more entry than thresholds
+_USER_STATUS_THRESHOLDS = (5, 10)
+_USER_STATUS_LABELS = ("New \U0001F331", "Regular \u2B50", "VIP \U0001F451") # Seedling, star, crown emoji
+
 def get_user_status(purchases):
     """Returns user status with emoji based on purchase count."""
     try:
-        p_int = int(purchases)
-        if p_int >= 10: return "VIP \U0001F451"  # Crown emoji
-        elif p_int >= 5: return "Regular \u2B50"  # Star emoji
-        else: return "New \U0001F331"  # Seedling emoji
+        return _USER_STATUS_LABELS[bisect_right(_USER_STATUS_THRESHOLDS, int(purchases))]
     except (ValueError, TypeError): 
-        return "New \U0001F331"
+        return _USER_STATUS_LABELS[0]
+
+# One basket item is "<product_id>:<unix time in integer ms>"; items are comma-separated.
+# Legacy items carry float seconds ("<id>:1712345678.123456") and are still accepted.
+# Anchored on item boundaries so a malformed item is skipped as a whole.
+_BASKET_ITEM_RE = re.compile(r'(?:^|(?<=,))(\d+):(\d+(?:\.\d+)?)(?=,|$)')
+
+def basket_item_str(product_id: int, timestamp: float) -> str:
+    """Builds the DB basket entry for a product reserved at `timestamp` (seconds)."""
+    return f"{product_id}:{round(timestamp * 1000)}"
+
+def _basket_ts_seconds(ts_str: str) -> float:
+    """Parses a stored basket timestamp back to seconds (ms ints, or legacy float seconds)."""
+    return float(ts_str) if '.' in ts_str else int(ts_str) / 1000
 
 # --- Modified clear_expired_basket (Individual user focus) ---
 def clear_expired_basket(context: ContextTypes.DEFAULT_TYPE, user_id: int):
     if 'basket' not in context.user_data: context.user_data['basket'] = []
-    conn = None
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("BEGIN")
-        c.execute("SELECT basket FROM users WHERE user_id = ?", (user_id,))
-        result = c.fetchone(); basket_str = result['basket'] if result else ''
-        if not basket_str:
-            # If DB basket is empty, ensure context basket is also empty
-            if context.user_data.get('basket'): context.user_data['basket'] = []
-            if context.user_data.get('applied_discount'): context.user_data.pop('applied_discount', None)
-            c.execute("COMMIT"); # Commit potential state change from BEGIN
-            return # Exit early if no basket string in DB
-
-        items = basket_str.split(',')
-        current_time = time.time(); valid_items_str_list = []; valid_items_userdata_list = []
-        expired_product_ids_counts = Counter(); expired_items_found = False
-        potential_prod_ids = []
-        for item_part in items:
-            if item_part and ':' in item_part:
-                try: potential_prod_ids.append(int(item_part.split(':')[0]))
-                except ValueError: logger.warning(f"Invalid product ID format in basket string '{item_part}' for user {user_id}")
-
-        product_details = {}
-        if potential_prod_ids:
-             placeholders = ','.join('?' * len(potential_prod_ids))
-             # Fetch product_type along with price
-             c.execute(f"SELECT id, price, product_type FROM products WHERE id IN ({placeholders})", potential_prod_ids)
-             product_details = {row['id']: {'price': Decimal(str(row['price'])), 'type': row['product_type']} for row in c.fetchall()}
-
-        for item_str in items:
-            if not item_str: continue
-            try:
-                prod_id_str, ts_str = item_str.split(':'); prod_id = int(prod_id_str); ts = float(ts_str)
+        # closing() releases the connection; `with conn` commits on success and rolls back on any exception
+        with closing(get_db_connection()) as conn, conn:
+            c = conn.cursor()
+            c.execute("BEGIN")
+            c.execute("SELECT basket FROM users WHERE user_id = ?", (user_id,))
+            result = c.fetchone(); basket_str = result['basket'] if result else ''
+            if not basket_str:
+                # If DB basket is empty, ensure context basket is also empty
+                if context.user_data.get('basket'): context.user_data['basket'] = []
+                if context.user_data.get('applied_discount'): context.user_data.pop('applied_discount', None)
+                return # Exit early if no basket string in DB
+
+            items = _BASKET_ITEM_RE.findall(basket_str) # [(prod_id_str, ts_str), ...]; malformed items never match
+            if len(items) <= basket_str.count(','):
+                logger.warning(f"Skipped {basket_str.count(',') + 1 - len(items)} malformed item(s) in basket for user {user_id}: '{basket_str}'")
+            current_time = time.time(); valid_items = []; valid_items_userdata_list = []
+            expired_product_ids = [] # Counted once after the loop
+            potential_prod_ids = [int(prod_id_str) for prod_id_str, _ in items]
+
+            product_details = {}
+            if potential_prod_ids:
+                 placeholders = ','.join('?' * len(potential_prod_ids))
+                 # Fetch product_type along with price
+                 c.execute(f"SELECT id, price, product_type FROM products WHERE id IN ({placeholders})", potential_prod_ids)
+                 product_details = {row['id']: {'price': Decimal(str(row['price'])), 'type': row['product_type']} for row in c.fetchall()}
+
+            for prod_id_str, ts_str in items:
+                prod_id = int(prod_id_str); ts = _basket_ts_seconds(ts_str)
                 if current_time - ts <= BASKET_TIMEOUT:
-                    valid_items_str_list.append(item_str)
+                    valid_items.append((prod_id_str, ts_str)) # Already-parsed pair, re-joined only if the basket changes
                     details = product_details.get(prod_id)
                     if details:
                         # Add product_type to context item
@@ -2315,130 +2593,106 @@ def clear_expired_basket(context: ContextTypes.DEFAULT_TYPE, user_id: int):
                         })
                     else: logger.warning(f"P{prod_id} details not found during basket validation (user {user_id}).")
                 else:
-                    expired_product_ids_counts[prod_id] += 1
-                    expired_items_found = True
-            except (ValueError, IndexError) as e: logger.warning(f"Malformed item '{item_str}' in basket for user {user_id}: {e}")
-
-        if expired_items_found:
-            new_basket_str = ','.join(valid_items_str_list)
-            c.execute("UPDATE users SET basket = ? WHERE user_id = ?", (new_basket_str, user_id))
-            if expired_product_ids_counts:
-                decrement_data = [(count, pid) for pid, count in expired_product_ids_counts.items()]
-                c.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
-                logger.info(f"Released {sum(expired_product_ids_counts.values())} reservations for user {user_id} due to expiry.")
-
-        c.execute("COMMIT") # Commit transaction
+                    expired_product_ids.append(prod_id)
+
+            if expired_product_ids:
+                expired_product_ids_counts = Counter(expired_product_ids)
+                new_basket_str = ','.join(f"{prod_id_str}:{ts_str}" for prod_id_str, ts_str in valid_items)
+                c.execute("UPDATE users SET basket = ? WHERE user_id = ?", (new_basket_str, user_id))
+                _release_product_reservations(c, expired_product_ids_counts)
+                logger.info(f"Released {len(expired_product_ids)} reservations for user {user_id} due to expiry.")
+
         context.user_data['basket'] = valid_items_userdata_list
         if not valid_items_userdata_list and context.user_data.get('applied_discount'):
             context.user_data.pop('applied_discount', None); logger.info(f"Cleared discount for user {user_id} as basket became empty.")
 
     except sqlite3.Error as e:
         logger.error(f"SQLite error clearing basket user {user_id}: {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
     except Exception as e:
         logger.error(f"Unexpected error clearing basket user {user_id}: {e}", exc_info=True)
-        if conn and conn.in_transaction: conn.rollback()
+
+_BASKET_SWEEP_CHUNK = 1000 # Users read, and their basket updates flushed, per chunk of the global sweep
+
+def _flush_basket_sweep_chunk(user_basket_updates: list[tuple], expired_product_ids: list[int]) -> bool:
+    """Writes one chunk of the global sweep (basket strings + released reservations) in one short transaction."""
+    conn_update = None
+    try:
+        conn_update = get_db_connection()
+        c_update = conn_update.cursor()
+        c_update.execute("BEGIN")
+        c_update.executemany("UPDATE users SET basket = ? WHERE user_id = ?", user_basket_updates)
+        _release_product_reservations(c_update, Counter(expired_product_ids)) # Counted in one C-level pass
+        conn_update.commit()
+        return True
+    except sqlite3.Error as e:
+        logger.error(f"SQLite error flushing basket updates in clear_all_expired_baskets: {e}", exc_info=True)
+        if conn_update and conn_update.in_transaction: conn_update.rollback()
+        return False
     finally:
-        if conn: conn.close()
+        if conn_update: conn_update.close()
 
 # --- MODIFIED clear_all_expired_baskets (Individual user processing) ---
 def clear_all_expired_baskets():
     logger.info("Running scheduled job: clear_all_expired_baskets (Improved)")
-    all_expired_product_counts = Counter()
     processed_user_count = 0
     failed_user_count = 0
+    updated_user_count = 0
+    total_released = 0
+    expiry_cutoff = time.time() - BASKET_TIMEOUT # Items stamped before this are expired
     conn_outer = None
-    users_to_process = []
 
-    # 1. Fetch all users with baskets first
+    # Stream users with baskets in chunks so memory stays O(chunk), flushing each chunk's updates as we go
     try:
         conn_outer = get_db_connection()
         c_outer = conn_outer.cursor()
         c_outer.execute("SELECT user_id, basket FROM users WHERE basket IS NOT NULL AND basket != ''")
-        users_to_process = c_outer.fetchall() # Fetch all relevant users
+        while True:
+            users_chunk = c_outer.fetchmany(_BASKET_SWEEP_CHUNK)
+            if not users_chunk:
+                break
+            user_basket_updates = [] # Batch updates for user basket strings
+            expired_product_ids = [] # Flat list of expired product IDs across the chunk
+
+            for user_row in users_chunk:
+                user_id = user_row['user_id']
+                basket_str = user_row['basket']
+                valid_items = []
+                expired_before = len(expired_product_ids)
+
+                items = _BASKET_ITEM_RE.findall(basket_str) # Malformed items never match and are dropped
+                for prod_id_str, ts_str in items:
+                    if _basket_ts_seconds(ts_str) >= expiry_cutoff:
+                        valid_items.append((prod_id_str, ts_str))
+                    else:
+                        expired_product_ids.append(int(prod_id_str))
+
+                if len(items) <= basket_str.count(','):
+                    logger.warning(f"Malformed item(s) skipped for user {user_id} in global clear: '{basket_str}'")
+                    failed_user_count += 1 # Mark user had an error, but continue processing others
+
+                # Only add to batch update if expired items were found for this user
+                if len(expired_product_ids) != expired_before:
+                    user_basket_updates.append((','.join(f"{prod_id_str}:{ts_str}" for prod_id_str, ts_str in valid_items), user_id))
+
+                processed_user_count += 1
+
+            if user_basket_updates:
+                if _flush_basket_sweep_chunk(user_basket_updates, expired_product_ids):
+                    updated_user_count += len(user_basket_updates)
+                    total_released += len(expired_product_ids)
+                else:
+                    failed_user_count += len(user_basket_updates)
     except sqlite3.Error as e:
-        logger.error(f"Failed to fetch users for basket clearing job: {e}", exc_info=True)
-        return # Cannot proceed if user fetch fails
+        logger.error(f"SQLite error reading baskets in clear_all_expired_baskets: {e}", exc_info=True)
     finally:
         if conn_outer: conn_outer.close()
 
-    if not users_to_process:
+    if not processed_user_count:
         logger.info("Scheduled clear: No users with active baskets found.")
         return
-
-    logger.info(f"Scheduled clear: Found {len(users_to_process)} users with baskets to check.")
-    current_time = time.time()
-    user_basket_updates = [] # Batch updates for user basket strings
-
-    # 2. Process each user individually for basket string updates and count expired items
-    for user_row in users_to_process:
-        user_id = user_row['user_id']
-        basket_str = user_row['basket']
-        items = basket_str.split(',')
-        valid_items_str_list = []
-        user_had_expired = False
-        user_error = False
-
-        for item_str in items:
-            if not item_str: continue
-            try:
-                prod_id_str, ts_str = item_str.split(':')
-                prod_id = int(prod_id_str)
-                ts = float(ts_str)
-                if current_time - ts <= BASKET_TIMEOUT:
-                    valid_items_str_list.append(item_str)
-                else:
-                    all_expired_product_counts[prod_id] += 1
-                    user_had_expired = True
-            except (ValueError, IndexError) as e:
-                logger.warning(f"Malformed item '{item_str}' user {user_id} in global clear: {e}")
-                user_error = True # Mark user had an error, but continue processing others
-                continue # Skip this malformed item
-
-        if user_error:
-            failed_user_count += 1
-
-        # Only add to batch update if expired items were found for this user
-        if user_had_expired:
-            new_basket_str = ','.join(valid_items_str_list)
-            user_basket_updates.append((new_basket_str, user_id))
-
-        processed_user_count += 1
-        # Optional: Add a small sleep if processing many users to avoid bursts
-        # time.sleep(0.01) # Using time.sleep in sync function is fine
-
-    # 3. Perform batch updates outside the user loop
-    conn_update = None
-    try:
-        conn_update = get_db_connection()
-        c_update = conn_update.cursor()
-        c_update.execute("BEGIN") # Start transaction for batch updates
-
-        # Update user basket strings
-        if user_basket_updates:
-            c_update.executemany("UPDATE users SET basket = ? WHERE user_id = ?", user_basket_updates)
-            logger.info(f"Scheduled clear: Updated basket strings for {len(user_basket_updates)} users.")
-
-        # Decrement reservations
-        if all_expired_product_counts:
-            decrement_data = [(count, pid) for pid, count in all_expired_product_counts.items()]
-            if decrement_data:
-                c_update.executemany("UPDATE products SET reserved = MAX(0, reserved - ?) WHERE id = ?", decrement_data)
-                total_released = sum(all_expired_product_counts.values())
-                logger.info(f"Scheduled clear: Released {total_released} expired product reservations.")
-
-        conn_update.commit() # Commit all updates together
-
-    except sqlite3.Error as e:
-        logger.error(f"SQLite error during batch updates in clear_all_expired_baskets: {e}", exc_info=True)
-        if conn_update and conn_update.in_transaction: conn_update.rollback()
-    except Exception as e:
-        logger.error(f"Unexpected error during batch updates in clear_all_expired_baskets: {e}", exc_info=True)
-        if conn_update and conn_update.in_transaction: conn_update.rollback()
-    finally:
-        if conn_update: conn_update.close()
-
-    logger.info(f"Scheduled job clear_all_expired_baskets finished. Processed: {processed_user_count}, Users with errors: {failed_user_count}, Total items un-reserved: {sum(all_expired_product_counts.values())}")
+    if updated_user_count:
+        logger.info(f"Scheduled clear: Updated basket strings for {updated_user_count} users, released {total_released} expired product reservations.")
+    logger.info(f"Scheduled job clear_all_expired_baskets finished. Processed: {processed_user_count}, Users with errors: {failed_user_count}, Total items un-reserved: {total_released}")
 
 
 def fetch_last_purchases(user_id, limit=10):
@@ -2527,42 +2781,21 @@ def get_crypto_price_eur(currency_code: str) -> Decimal | None:
         logger.error(f"Error parsing CoinGecko price response for {currency_code_lower}: {e}")
         return None
 
+try:
+    _LITHUANIAN_TZ = ZoneInfo('Europe/Vilnius')
+except ZoneInfoNotFoundError:
+    # No IANA database on this host (tzdata not installed): fixed UTC+2, off by an hour during DST
+    logger.warning("Europe/Vilnius timezone data not found; showing expiration times as UTC+2.")
+    _LITHUANIAN_TZ = timezone(timedelta(hours=2))
+
 def format_expiration_time(expiration_date_str: str | None) -> str:
     if not expiration_date_str: return "N/A"
     try:
-        # Import pytz for timezone conversion
-        import pytz
-        
-        # Ensure the string ends with timezone info for fromisoformat
-        if not expiration_date_str.endswith('Z') and '+' not in expiration_date_str and '-' not in expiration_date_str[10:]:
-            expiration_date_str += 'Z' # Assume UTC if no timezone
         dt_obj = datetime.fromisoformat(expiration_date_str.replace('Z', '+00:00'))
-        
+        if dt_obj.tzinfo is None:
+            dt_obj = dt_obj.replace(tzinfo=timezone.utc) # Assume UTC if no timezone
         # Convert to Lithuanian timezone (Europe/Vilnius)
-        lithuanian_tz = pytz.timezone('Europe/Vilnius')
-        if dt_obj.tzinfo:
-            # Convert UTC to Lithuanian time
-            lithuanian_time = dt_obj.astimezone(lithuanian_tz)
-            return lithuanian_time.strftime("%H:%M:%S LT")  # LT = Local Time (Lithuanian)
-        else:
-            # If no timezone info, assume UTC and convert
-            utc_time = dt_obj.replace(tzinfo=pytz.UTC)
-            lithuanian_time = utc_time.astimezone(lithuanian_tz)
-            return lithuanian_time.strftime("%H:%M:%S LT")
-    except ImportError:
-        # Fallback if pytz is not available - use manual offset
-        try:
-            if not expiration_date_str.endswith('Z') and '+' not in expiration_date_str and '-' not in expiration_date_str[10:]:
-                expiration_date_str += 'Z'
-            dt_obj = datetime.fromisoformat(expiration_date_str.replace('Z', '+00:00'))
-            # Lithuania is UTC+2 (UTC+3 during DST)
-            # For simplicity, add 2 hours (this is a fallback)
-            from datetime import timedelta
-            lithuanian_time = dt_obj + timedelta(hours=2)
-            return lithuanian_time.strftime("%H:%M:%S LT")
-        except Exception as fallback_e:
-            logger.warning(f"Fallback timezone conversion failed for '{expiration_date_str}': {fallback_e}")
-            return "Invalid Date"
+        return dt_obj.astimezone(_LITHUANIAN_TZ).strftime("%H:%M:%S LT")  # LT = Local Time (Lithuanian)
     except (ValueError, TypeError) as e: 
         logger.warning(f"Could not parse expiration date string '{expiration_date_str}': {e}"); 
         return "Invalid Date"
@@ -2577,174 +2810,237 @@ async def handle_coming_soon(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
 
 # --- Fetch User IDs for Broadcast (Synchronous) ---
-def fetch_user_ids_for_broadcast(target_type: str, target_value: str | int | None = None) -> list[int]:
-    """Fetches user IDs based on broadcast target criteria."""
-    user_ids = []
-    conn = None
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-
-        if target_type == 'all':
-            # Send to ALL users who have ever pressed /start (exist in users table) except banned ones
-            # TEMPORARILY REMOVED broadcast_failed_count filtering to ensure ALL users get messages
-            c.execute("SELECT user_id FROM users WHERE is_banned = 0 ORDER BY total_purchases DESC")
-            user_ids = [row['user_id'] for row in c.fetchall()]
-            logger.info(f"Broadcast target 'all': Found {len(user_ids)} users (excluding only banned users).")
-
-        elif target_type == 'status' and target_value:
-            status = str(target_value).lower()
-            min_purchases, max_purchases = -1, -1
-            # Use the status string including emoji for matching (rely on English definition)
-            if status == LANGUAGES['en'].get("broadcast_status_vip", "VIP 👑").lower(): min_purchases = 10; max_purchases = float('inf')
-            elif status == LANGUAGES['en'].get("broadcast_status_regular", "Regular ⭐").lower(): min_purchases = 5; max_purchases = 9
-            elif status == LANGUAGES['en'].get("broadcast_status_new", "New 🌱").lower(): min_purchases = 0; max_purchases = 4
-
-            if min_purchases != -1:
-                 if max_purchases == float('inf'):
-                     c.execute("SELECT user_id FROM users WHERE total_purchases >= ? AND is_banned=0", (min_purchases,)) # Exclude banned
-                 else:
-                     c.execute("SELECT user_id FROM users WHERE total_purchases BETWEEN ? AND ? AND is_banned=0", (min_purchases, max_purchases)) # Exclude banned
-                 user_ids = [row['user_id'] for row in c.fetchall()]
-                 logger.info(f"Broadcast target status '{target_value}': Found {len(user_ids)} non-banned users.")
-            else: logger.warning(f"Invalid status value for broadcast: {target_value}")
-
-        elif target_type == 'city' and target_value:
-            city_name = str(target_value)
-            # Find non-banned users whose *most recent* purchase was in this city
-            c.execute("""
-                SELECT p1.user_id
-                FROM purchases p1
-                JOIN users u ON p1.user_id = u.user_id
-                WHERE p1.city = ? AND u.is_banned = 0 AND p1.purchase_date = (
-                    SELECT MAX(purchase_date)
-                    FROM purchases p2
-                    WHERE p1.user_id = p2.user_id
-                )
-            """, (city_name,))
-            user_ids = [row['user_id'] for row in c.fetchall()]
-            logger.info(f"Broadcast target city '{city_name}': Found {len(user_ids)} non-banned users based on last purchase.")
+MAX_BROADCAST_USERS = 10000  # Reasonable limit per broadcast
+# Broadcast status label (English definition, lowercased, emoji included) -> (min_purchases, max_purchases or None)
+_BROADCAST_STATUS_MAP = {
+    LANGUAGES['en'].get("broadcast_status_vip", "VIP 👑").lower(): (10, None),
+    LANGUAGES['en'].get("broadcast_status_regular", "Regular ⭐").lower(): (5, 9),
+    LANGUAGES['en'].get("broadcast_status_new", "New 🌱").lower(): (0, 4),
+}
 
-        elif target_type == 'inactive' and target_value:
-            try:
-                days_inactive = int(target_value)
-                if days_inactive <= 0: raise ValueError("Days must be positive")
-                cutoff_date = datetime.now(timezone.utc) - timedelta(days=days_inactive)
-                cutoff_iso = cutoff_date.isoformat()
-
-                # Find non-banned users whose last purchase date is older than the cutoff date OR have no purchases
-                # 1. Get users with last purchase older than cutoff
-                c.execute("""
-                    SELECT p1.user_id
-                    FROM purchases p1
-                    JOIN users u ON p1.user_id = u.user_id
-                    WHERE u.is_banned = 0 AND p1.purchase_date = (
-                        SELECT MAX(purchase_date)
-                        FROM purchases p2
-                        WHERE p1.user_id = p2.user_id
-                    ) AND p1.purchase_date < ?
-                """, (cutoff_iso,))
-                inactive_users = {row['user_id'] for row in c.fetchall()}
-
-                # 2. Get users with zero purchases (who implicitly meet the inactive criteria)
-                c.execute("SELECT user_id FROM users WHERE total_purchases = 0 AND is_banned = 0") # Exclude banned
-                zero_purchase_users = {row['user_id'] for row in c.fetchall()}
-
-                # Combine the sets
-                user_ids_set = inactive_users.union(zero_purchase_users)
-                user_ids = list(user_ids_set)
-                logger.info(f"Broadcast target inactive >= {days_inactive} days: Found {len(user_ids)} non-banned users.")
-
-            except (ValueError, TypeError):
-                logger.error(f"Invalid number of days for inactive broadcast: {target_value}")
+# Broadcast SQL is kept as module constants: pooled connections are long-lived, so reusing the exact
+# same text lets sqlite3's per-connection statement cache skip re-parsing on every call.
+_SQL_BROADCAST_TARGET_ALL = "SELECT user_id FROM users WHERE is_banned = 0 ORDER BY total_purchases DESC LIMIT ?"
+_SQL_BROADCAST_TARGET_MIN_PURCHASES = "SELECT user_id FROM users WHERE total_purchases >= ? AND is_banned=0"
+_SQL_BROADCAST_TARGET_PURCHASE_RANGE = "SELECT user_id FROM users WHERE total_purchases BETWEEN ? AND ? AND is_banned=0"
+_SQL_BROADCAST_TARGET_CITY = "SELECT user_id FROM users WHERE is_banned = 0 AND last_purchase_city = ?"
+_SQL_BROADCAST_TARGET_INACTIVE = "SELECT user_id FROM users WHERE is_banned = 0 AND (last_purchase_date IS NULL OR last_purchase_date < ?)"
+
+def _broadcast_target_query(target_type: str, target_value: str | int | None) -> tuple[str, tuple, str] | None:
+    """Maps broadcast target criteria to (sql, params, description). None if the target is invalid."""
+    if target_type == 'all':
+        # Send to ALL users who have ever pressed /start (exist in users table) except banned ones
+        # TEMPORARILY REMOVED broadcast_failed_count filtering to ensure ALL users get messages
+        # Cap in SQL: walks idx_users_active_purchases backwards and stops after the limit (no full sort)
+        return (_SQL_BROADCAST_TARGET_ALL,
+                (MAX_BROADCAST_USERS,), "'all' (excluding only banned users)")
+
+    elif target_type == 'status' and target_value:
+        # Use the status string including emoji for matching (rely on English definition)
+        bounds = _BROADCAST_STATUS_MAP.get(str(target_value).lower())
+        if bounds is None:
+            logger.warning(f"Invalid status value for broadcast: {target_value}")
+            return None
+        min_purchases, max_purchases = bounds
+        if max_purchases is None:
+            return (_SQL_BROADCAST_TARGET_MIN_PURCHASES, # Exclude banned
+                    (min_purchases,), f"status '{target_value}'")
+        return (_SQL_BROADCAST_TARGET_PURCHASE_RANGE, # Exclude banned
+                (min_purchases, max_purchases), f"status '{target_value}'")
+
+    elif target_type == 'city' and target_value:
+        city_name = str(target_value)
+        # Find non-banned users whose *most recent* purchase was in this city
+        return (_SQL_BROADCAST_TARGET_CITY,
+                (city_name,), f"city '{city_name}' (by last purchase)")
+
+    elif target_type == 'inactive' and target_value:
+        try:
+            days_inactive = int(target_value)
+            if days_inactive <= 0: raise ValueError("Days must be positive")
+        except (ValueError, TypeError):
+            logger.error(f"Invalid number of days for inactive broadcast: {target_value}")
+            return None
+        cutoff_iso = (datetime.now(timezone.utc) - timedelta(days=days_inactive)).isoformat()
+        # Find non-banned users whose last purchase date is older than the cutoff date OR have no purchases
+        return (_SQL_BROADCAST_TARGET_INACTIVE,
+                (cutoff_iso,), f"inactive >= {days_inactive} days")
 
-        else:
-            logger.error(f"Unknown broadcast target type or missing value: type={target_type}, value={target_value}")
+    logger.error(f"Unknown broadcast target type or missing value: type={target_type}, value={target_value}")
+    return None
 
+def iter_broadcast_target_users(target_type: str, target_value: str | int | None = None) -> Iterator[int]:
+    """Yields non-banned user IDs matching the broadcast target, straight from the cursor (at most MAX_BROADCAST_USERS).
+    A pooled reader connection is held until the generator is exhausted or closed."""
+    query = _broadcast_target_query(target_type, target_value)
+    if query is None:
+        return
+    sql, params, description = query
+    yielded = 0
+    try:
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            c.row_factory = None # Single-column results: plain tuples are cheaper than sqlite3.Row lookups
+            # IMPROVED: Limit broadcast size to prevent overwhelming the system ('all' is already capped in SQL)
+            for user_id in islice((row[0] for row in c.execute(sql, params)), MAX_BROADCAST_USERS):
+                yielded += 1
+                yield user_id
     except sqlite3.Error as e:
         logger.error(f"DB error fetching users for broadcast ({target_type}, {target_value}): {e}", exc_info=True)
     except Exception as e:
         logger.error(f"Unexpected error fetching users for broadcast: {e}", exc_info=True)
-    finally:
-        if conn: conn.close()
-
-    # IMPROVED: Limit broadcast size to prevent overwhelming the system
-    max_broadcast_users = 10000  # Reasonable limit
-    if len(user_ids) > max_broadcast_users:
-        logger.warning(f"Broadcast target too large ({len(user_ids)} users), limiting to {max_broadcast_users}")
-        user_ids = user_ids[:max_broadcast_users]
-
-    return user_ids
+    logger.info(f"Broadcast target {description}: {yielded} non-banned users.")
+    if yielded == MAX_BROADCAST_USERS:
+        logger.warning(f"Broadcast target {description} capped at {MAX_BROADCAST_USERS} users")
 
+def fetch_user_ids_for_broadcast(target_type: str, target_value: str | int | None = None) -> list[int]:
+    """Fetches user IDs based on broadcast target criteria (list form of iter_broadcast_target_users)."""
+    return list(iter_broadcast_target_users(target_type, target_value))
+
+
+# --- Cached UTC timestamp for high-volume bookkeeping rows ---
+# Broadcast status and admin log rows only need second precision, so the ISO string is formatted
+# once per wall-clock second instead of per row. User-facing records keep precise timestamps.
+_iso_now_cache = (None, None) # (epoch second, iso string); replaced atomically as one tuple
+
+def _iso_now_cached() -> str:
+    global _iso_now_cache
+    now_sec = int(time.time())
+    cached_sec, cached_iso = _iso_now_cache
+    if now_sec != cached_sec:
+        cached_iso = datetime.fromtimestamp(now_sec, tz=timezone.utc).isoformat()
+        _iso_now_cache = (now_sec, cached_iso)
+    return cached_iso
+
+
+# --- User Broadcast Status Tracking (Synchronous, batched) ---
+# Status changes are queued and written in one transaction per batch instead of one per user.
+BROADCAST_STATUS_FLUSH_SIZE = 500       # Flush as soon as this many updates are queued
+BROADCAST_STATUS_FLUSH_INTERVAL = 1.0   # ...or this many seconds after the first queued update
+BROADCAST_UNREACHABLE_THRESHOLD = 5     # Consecutive failures after which a user is logged as unreachable
+_SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0) # UPDATE ... RETURNING support
+_SQL_BROADCAST_RESET = "UPDATE users SET broadcast_failed_count = ?, last_active = ? WHERE user_id = ?"
+_SQL_BROADCAST_INCREMENT = "UPDATE users SET broadcast_failed_count = COALESCE(broadcast_failed_count, 0) + ? WHERE user_id = ?"
+_SQL_BROADCAST_INCREMENT_RETURNING = _SQL_BROADCAST_INCREMENT + " RETURNING broadcast_failed_count"
+_BROADCAST_UNREACHABLE_CHECK_CHUNK = 900 # Fixed chunk size keeps the IN (...) statement text (and its cache entry) stable
+_SQL_BROADCAST_UNREACHABLE_CHECK = (
+    "SELECT user_id, broadcast_failed_count FROM users WHERE broadcast_failed_count >= ? AND user_id IN ("
+    + ','.join('?' * _BROADCAST_UNREACHABLE_CHECK_CHUNK) + ")"
+)
+
+_broadcast_status_queue = deque()       # (user_id, success, iso_time) in arrival order
+_broadcast_status_lock = threading.Lock()
+_broadcast_status_timer: threading.Timer | None = None
+# Users already at/over BROADCAST_UNREACHABLE_THRESHOLD: further failures aren't written (guarded by _broadcast_status_lock)
+_unreachable_users: set[int] = set()
+
+def load_unreachable_users():
+    """Loads the known-unreachable users at startup so their broadcast failures skip the DB."""
+    try:
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            c.row_factory = None
+            c.execute("SELECT user_id FROM users WHERE broadcast_failed_count >= ?", (BROADCAST_UNREACHABLE_THRESHOLD,))
+            user_ids = {user_id for (user_id,) in c.fetchall()}
+    except sqlite3.Error as e:
+        logger.error(f"Failed to load unreachable broadcast users: {e}", exc_info=True)
+        return
+    with _broadcast_status_lock:
+        _unreachable_users.clear(); _unreachable_users.update(user_ids)
+    logger.info(f"Loaded {len(user_ids)} unreachable broadcast users.")
 
-# --- User Broadcast Status Tracking (Synchronous) ---
 def update_user_broadcast_status(user_id: int, success: bool):
-    """Update user's broadcast status based on success/failure."""
-    conn = None
+    """Queue a broadcast status update (success resets failures and bumps last_active, failure increments).
+    Written by flush_broadcast_status_updates() on a timer thread once the batch is full or FLUSH_INTERVAL elapses,
+    so this never blocks the caller on the database."""
+    global _broadcast_status_timer
+    with _broadcast_status_lock:
+        if success:
+            _unreachable_users.discard(user_id) # Reachable again; the queued reset clears the DB counter
+        elif user_id in _unreachable_users:
+            return # Already over the threshold - another increment changes nothing
+        _broadcast_status_queue.append((user_id, success, _iso_now_cached()))
+        if len(_broadcast_status_queue) >= BROADCAST_STATUS_FLUSH_SIZE:
+            # Batch full: flush now, but on the timer thread - callers are async handlers and the
+            # flush's BEGIN IMMEDIATE can wait up to busy_timeout for the write lock
+            if _broadcast_status_timer is not None and _broadcast_status_timer.interval == 0:
+                return # An immediate flush is already scheduled
+            delay = 0
+        elif _broadcast_status_timer is None:
+            delay = BROADCAST_STATUS_FLUSH_INTERVAL
+        else:
+            return
+        if _broadcast_status_timer is not None:
+            _broadcast_status_timer.cancel()
+        _broadcast_status_timer = threading.Timer(delay, flush_broadcast_status_updates)
+        _broadcast_status_timer.daemon = True
+        _broadcast_status_timer.start()
+
+def _collapse_broadcast_status_updates(updates) -> tuple[list[tuple], list[tuple]]:
+    """Folds queued updates into one write per user, preserving order semantics.
+    Returns (resets, increments):
+    - resets: (failures_since_last_success, last_success_time, user_id) for users with a success in the batch
+    - increments: (failure_count, user_id) for users that only failed"""
+    per_user = {} # user_id -> [failures since last success, last success time or None]
+    for user_id, success, at in updates:
+        state = per_user.setdefault(user_id, [0, None])
+        if success: state[0] = 0; state[1] = at
+        else: state[0] += 1
+    resets = [(failures, at, user_id) for user_id, (failures, at) in per_user.items() if at is not None]
+    increments = [(failures, user_id) for user_id, (failures, at) in per_user.items() if at is None]
+    return resets, increments
+
+def flush_broadcast_status_updates():
+    """Write all queued broadcast status updates in a single transaction (safe to call from any thread)."""
+    global _broadcast_status_timer
+    with _broadcast_status_lock:
+        if _broadcast_status_timer is not None:
+            _broadcast_status_timer.cancel()
+            _broadcast_status_timer = None
+        updates = list(_broadcast_status_queue)
+        _broadcast_status_queue.clear()
+    if not updates:
+        return
+
+    resets, increments = _collapse_broadcast_status_updates(updates)
     max_retries = 3
-    
     for attempt in range(max_retries):
         try:
-            conn = get_db_connection()
-            c = conn.cursor()
-            
-            if success:
-                # Reset failure count and update last active time
-                current_time = datetime.now(timezone.utc).isoformat()
-                c.execute("""
-                    UPDATE users 
-                    SET broadcast_failed_count = 0, last_active = ?
-                    WHERE user_id = ?
-                """, (current_time, user_id))
-                logger.debug(f"Reset broadcast failure count for user {user_id}")
-            else:
-                # Increment failure count
-                c.execute("""
-                    UPDATE users 
-                    SET broadcast_failed_count = COALESCE(broadcast_failed_count, 0) + 1
-                    WHERE user_id = ?
-                """, (user_id,))
-                
-                # Check new failure count
-                c.execute("SELECT broadcast_failed_count FROM users WHERE user_id = ?", (user_id,))
-                result = c.fetchone()
-                if result and result['broadcast_failed_count'] >= 5:
-                    logger.info(f"User {user_id} marked as unreachable after {result['broadcast_failed_count']} consecutive failures")
-            
-            conn.commit()
-            return  # Success, exit the retry loop
-            
+            with db_pool.acquire_telemetry_writer() as conn: # Rolled back by the pool if anything below raises
+                c = conn.cursor()
+                c.execute("BEGIN IMMEDIATE") # Take the write lock up front; no upgrade deadlock mid-batch
+                if resets:
+                    c.executemany(_SQL_BROADCAST_RESET, resets)
+                unreachable = [] # (user_id, broadcast_failed_count) at/over the threshold
+                if increments and _SQLITE_HAS_RETURNING:
+                    # One statement per user that also hands back the new count
+                    for failures, user_id in increments:
+                        row = c.execute(_SQL_BROADCAST_INCREMENT_RETURNING, (failures, user_id)).fetchone()
+                        if row and row[0] >= BROADCAST_UNREACHABLE_THRESHOLD: unreachable.append((user_id, row[0]))
+                elif increments:
+                    c.executemany(_SQL_BROADCAST_INCREMENT, increments)
+                    failed_ids = [user_id for _, user_id in increments]
+                    for start in range(0, len(failed_ids), _BROADCAST_UNREACHABLE_CHECK_CHUNK):
+                        chunk = failed_ids[start:start + _BROADCAST_UNREACHABLE_CHECK_CHUNK]
+                        chunk += [None] * (_BROADCAST_UNREACHABLE_CHECK_CHUNK - len(chunk)) # Pad: NULL never matches IN
+                        c.execute(_SQL_BROADCAST_UNREACHABLE_CHECK, (BROADCAST_UNREACHABLE_THRESHOLD, *chunk))
+                        unreachable.extend((row['user_id'], row['broadcast_failed_count']) for row in c.fetchall())
+                conn.commit()
+                if unreachable:
+                    with _broadcast_status_lock:
+                        _unreachable_users.update(user_id for user_id, _ in unreachable)
+                for user_id, failed_count in unreachable:
+                    logger.info(f"User {user_id} marked as unreachable after {failed_count} consecutive failures")
+            logger.debug(f"Flushed {len(updates)} broadcast status updates ({len(resets)} reset, {len(increments)} failed users)")
+            return
         except sqlite3.Error as e:
-            logger.error(f"DB error updating broadcast status for user {user_id} (attempt {attempt+1}/{max_retries}): {e}")
-            if conn and conn.in_transaction:
-                try:
-                    conn.rollback()
-                except:
-                    pass
+            logger.error(f"DB error flushing {len(updates)} broadcast status updates (attempt {attempt+1}/{max_retries}): {e}")
             if attempt < max_retries - 1:
                 time.sleep(0.1 * (attempt + 1))  # Brief delay before retry
-                continue
             else:
-                logger.error(f"Failed to update broadcast status for user {user_id} after {max_retries} attempts")
-        except Exception as e:
-            logger.error(f"Unexpected error updating broadcast status for user {user_id} (attempt {attempt+1}/{max_retries}): {e}")
-            if conn and conn.in_transaction:
-                try:
-                    conn.rollback()
-                except:
-                    pass
-            if attempt < max_retries - 1:
-                time.sleep(0.1 * (attempt + 1))  # Brief delay before retry
-                continue
-            else:
-                logger.error(f"Failed to update broadcast status for user {user_id} after {max_retries} attempts")
-        finally:
-            if conn:
-                try:
-                    conn.close()
-                except:
-                    pass
-                conn = None
+                logger.error(f"Failed to flush {len(updates)} broadcast status updates after {max_retries} attempts")
+
+atexit.register(flush_broadcast_status_updates) # Don't drop a partially filled batch on shutdown
 
 
 # --- Admin Action Logging (Synchronous) ---
@@ -2759,73 +3055,159 @@ ACTION_PRODUCT_TYPE_REASSIGN = "PRODUCT_TYPE_REASSIGN"
 ACTION_BULK_PRICE_UPDATE = "BULK_PRICE_UPDATE"
 # <<< END Define >>>
 
+# Admin log rows are queued and written in batches by a background thread (one transaction per batch).
+ADMIN_LOG_BATCH_SIZE = 200
+_ADMIN_LOG_INSERT_SQL = """
+    INSERT INTO admin_log (timestamp, admin_id, target_user_id, action, reason, amount_change, old_value, new_value)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+_admin_log_queue: queue.Queue = queue.Queue(maxsize=10000)
+
+def _write_admin_log_rows(rows: list[tuple]):
+    with db_pool.acquire_writer() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany(_ADMIN_LOG_INSERT_SQL, rows)
+        conn.commit()
+    for _, admin_id, target_user_id, action, reason, amount_change, old_value, new_value in rows:
+        logger.info(f"Admin Action Logged: Admin={admin_id}, Action='{action}', Target={target_user_id}, Reason='{reason}', Amount={amount_change}, Old='{old_value}', New='{new_value}'")
+
+def _log_admin_log_failure(rows: list[tuple], e: Exception):
+    # The rows are gone at this point - name each lost action so it can be reconstructed by hand
+    logger.error(f"Failed to write {len(rows)} admin log rows: {e}", exc_info=True)
+    for _, admin_id, target_user_id, action, *_ in rows:
+        logger.error(f"Admin Action NOT Logged: Admin={admin_id}, Action='{action}', Target={target_user_id}")
+
+def _drain_admin_log_queue(rows: list[tuple], limit: int) -> list[tuple]:
+    while len(rows) < limit:
+        try: rows.append(_admin_log_queue.get_nowait())
+        except queue.Empty: break
+    return rows
+
+def flush_admin_log():
+    """Write every queued admin log row now (used at shutdown)."""
+    while True:
+        rows = _drain_admin_log_queue([], ADMIN_LOG_BATCH_SIZE)
+        if not rows: return
+        try: _write_admin_log_rows(rows)
+        except sqlite3.Error as e: _log_admin_log_failure(rows, e); return
+
+def _admin_log_writer_loop():
+    while True:
+        try: first_row = _admin_log_queue.get(timeout=1.0)
+        except queue.Empty: continue
+        rows = _drain_admin_log_queue([first_row], ADMIN_LOG_BATCH_SIZE)
+        try: _write_admin_log_rows(rows)
+        except Exception as e: _log_admin_log_failure(rows, e)
+
+_admin_log_writer: threading.Thread | None = None
+
+def start_admin_log_writer():
+    """Starts the background admin-log writer (called once by main.py at startup).
+    Until it runs (e.g. scripts importing utils), log_admin_action inserts directly."""
+    global _admin_log_writer
+    if _admin_log_writer is None:
+        _admin_log_writer = threading.Thread(target=_admin_log_writer_loop, name="admin-log-writer", daemon=True)
+        _admin_log_writer.start()
+
+atexit.register(flush_admin_log)
+
 def log_admin_action(admin_id: int, action: str, target_user_id: int | None = None, reason: str | None = None, amount_change: float | None = None, old_value=None, new_value=None):
-    """Logs an administrative action to the admin_log table."""
+    """Logs an administrative action to the admin_log table (queued; written by the admin-log writer thread)."""
+    row = (
+        _iso_now_cached(),
+        admin_id,
+        target_user_id,
+        action, # Ensure action string is passed correctly
+        reason,
+        amount_change,
+        str(old_value) if old_value is not None else None,
+        str(new_value) if new_value is not None else None
+    )
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute("""
-                INSERT INTO admin_log (timestamp, admin_id, target_user_id, action, reason, amount_change, old_value, new_value)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                datetime.now(timezone.utc).isoformat(),
-                admin_id,
-                target_user_id,
-                action, # Ensure action string is passed correctly
-                reason,
-                amount_change,
-                str(old_value) if old_value is not None else None,
-                str(new_value) if new_value is not None else None
-            ))
-            conn.commit()
-            logger.info(f"Admin Action Logged: Admin={admin_id}, Action='{action}', Target={target_user_id}, Reason='{reason}', Amount={amount_change}, Old='{old_value}', New='{new_value}'")
-    except sqlite3.Error as e:
-        logger.error(f"Failed to log admin action: {e}", exc_info=True)
-    except Exception as e:
-        logger.error(f"Unexpected error logging admin action: {e}", exc_info=True)
+        if _admin_log_writer is None: raise queue.Full # No writer thread (not started by main.py) - insert directly
+        _admin_log_queue.put_nowait(row)
+    except queue.Full:
+        # Writer thread is far behind (or absent) - fall back to a direct synchronous insert
+        try: _write_admin_log_rows([row])
+        except sqlite3.Error as e: _log_admin_log_failure([row], e)
+        return
+    # "Logged" (or the failure) is reported by the writer thread once the row is actually written
+    logger.debug(f"Admin Action Queued: Admin={admin_id}, Action='{action}', Target={target_user_id}")
 
 # --- Admin Authorization Helpers ---
 def is_primary_admin(user_id: int) -> bool:
     """Check if a user ID is a primary admin."""
-    return user_id in PRIMARY_ADMIN_IDS
+    return user_id in _PRIMARY_ADMIN_ID_SET
 
 def is_secondary_admin(user_id: int) -> bool:
     """Check if a user ID is a secondary admin."""
-    return user_id in SECONDARY_ADMIN_IDS
+    return user_id in _SECONDARY_ADMIN_ID_SET
 
 def is_any_admin(user_id: int) -> bool:
     """Check if a user ID is either a primary or secondary admin."""
-    return is_primary_admin(user_id) or is_secondary_admin(user_id)
+    return user_id in _ALL_ADMIN_IDS
 
 def get_first_primary_admin_id() -> int | None:
     """Get the first primary admin ID for legacy compatibility, or None if none configured."""
     return PRIMARY_ADMIN_IDS[0] if PRIMARY_ADMIN_IDS else None
 
 # --- Welcome Message Helpers (Synchronous) ---
+# --- Active welcome template cache ---
+# (active_name, template_text) is kept in memory and revalidated with PRAGMA data_version, which changes
+# whenever ANY other connection (including admin.py's direct writes) commits to the DB. data_version is
+# only comparable on one connection, so a single long-lived connection is kept just for this check.
+_welcome_cache = {'version': None, 'active_name': None, 'text': None}
+_welcome_cache_lock = threading.Lock()
+_welcome_version_conn: sqlite3.Connection | None = None
+
+def _invalidate_welcome_cache():
+    with _welcome_cache_lock:
+        _welcome_cache['version'] = None
+
+def get_active_welcome_template() -> tuple[str, str | None]:
+    """Returns (active template name, its template_text or None if that template doesn't exist).
+    Served from memory until the database changes. Raises sqlite3.Error on DB failure."""
+    global _welcome_version_conn
+    with _welcome_cache_lock:
+        try:
+            if _welcome_version_conn is None:
+                _welcome_version_conn = get_db_connection()
+            version = _welcome_version_conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == _welcome_cache['version']:
+                return _welcome_cache['active_name'], _welcome_cache['text']
+
+            c = _welcome_version_conn.cursor()
+            c.execute("SELECT setting_value FROM bot_settings WHERE setting_key = ?", ("active_welcome_message_name",))
+            setting_row = c.fetchone()
+            active_name = setting_row['setting_value'] if setting_row and setting_row['setting_value'] else "default"
+            c.execute("SELECT template_text FROM welcome_messages WHERE name = ?", (active_name,))
+            template_row = c.fetchone()
+        except sqlite3.Error:
+            # Drop the (possibly broken) connection and cached state; next call starts fresh
+            if _welcome_version_conn is not None:
+                try: _welcome_version_conn.close()
+                except sqlite3.Error: pass
+            _welcome_version_conn = None; _welcome_cache['version'] = None
+            raise
+        _welcome_cache.update(version=version, active_name=active_name, text=template_row['template_text'] if template_row else None)
+        return _welcome_cache['active_name'], _welcome_cache['text']
+
 def load_active_welcome_message() -> str:
-    """Loads the currently active welcome message template from the database."""
-    conn = None
+    """Loads the currently active welcome message template (cached, see get_active_welcome_template)."""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute("SELECT setting_value FROM bot_settings WHERE setting_key = ?", ("active_welcome_message_name",))
-        setting_row = c.fetchone()
-        active_name = setting_row['setting_value'] if setting_row else "default"
-
-        c.execute("SELECT template_text FROM welcome_messages WHERE name = ?", (active_name,))
-        template_row = c.fetchone()
-        if template_row:
-            logger.info(f"Loaded active welcome message template: '{active_name}'")
-            return template_row['template_text']
+        active_name, template_text = get_active_welcome_template()
+        if template_text is not None:
+            logger.debug(f"Loaded active welcome message template: '{active_name}'")
+            return template_text
         else:
             # If active template name points to a non-existent template, try fallback
             logger.warning(f"Active welcome message template '{active_name}' not found. Trying 'default'.")
-            c.execute("SELECT template_text FROM welcome_messages WHERE name = ?", ("default",))
-            template_row = c.fetchone()
+            with db_pool.acquire() as conn:
+                template_row = conn.execute("SELECT template_text FROM welcome_messages WHERE name = ?", ("default",)).fetchone()
             if template_row:
                 logger.info("Loaded fallback 'default' welcome message template.")
                 # Optionally update setting to default?
-                # c.execute("UPDATE bot_settings SET setting_value = ? WHERE setting_key = ?", ("default", "active_welcome_message_name"))
+                # conn.execute("UPDATE bot_settings SET setting_value = ? WHERE setting_key = ?", ("default", "active_welcome_message_name"))
                 # conn.commit()
                 return template_row['template_text']
             else:
@@ -2839,15 +3221,13 @@ def load_active_welcome_message() -> str:
     except Exception as e:
         logger.error(f"Unexpected error loading welcome message: {e}", exc_info=True)
         return DEFAULT_WELCOME_MESSAGE
-    finally:
-        if conn: conn.close()
 
 # <<< MODIFIED: Fetch description as well >>>
 def get_welcome_message_templates(limit: int | None = None, offset: int = 0) -> list[dict]:
     """Fetches welcome message templates (name, text, description), optionally paginated."""
     templates = []
     try:
-        with get_db_connection() as conn:
+        with db_pool.acquire() as conn:
             c = conn.cursor()
             query = "SELECT name, template_text, description FROM welcome_messages ORDER BY name"
             params = []
@@ -2865,7 +3245,7 @@ def get_welcome_message_template_count() -> int:
     """Gets the total number of welcome message templates."""
     count = 0
     try:
-        with get_db_connection() as conn:
+        with db_pool.acquire() as conn:
             c = conn.cursor()
             c.execute("SELECT COUNT(*) FROM welcome_messages")
             result = c.fetchone()
@@ -2878,11 +3258,11 @@ def get_welcome_message_template_count() -> int:
 def add_welcome_message_template(name: str, template_text: str, description: str | None = None) -> bool:
     """Adds a new welcome message template."""
     try:
-        with get_db_connection() as conn:
+        with db_pool.acquire_writer() as conn:
             c = conn.cursor()
             c.execute("INSERT INTO welcome_messages (name, template_text, description) VALUES (?, ?, ?)",
                       (name, template_text, description))
-            conn.commit()
+            conn.commit(); _invalidate_welcome_cache()
             logger.info(f"Added welcome message template: '{name}'")
             return True
     except sqlite3.IntegrityError:
@@ -2913,10 +3293,10 @@ def update_welcome_message_template(name: str, new_template_text: str | None = N
     sql = f"UPDATE welcome_messages SET {', '.join(updates)} WHERE name = ?"
 
     try:
-        with get_db_connection() as conn:
+        with db_pool.acquire_writer() as conn:
             c = conn.cursor()
             result = c.execute(sql, params)
-            conn.commit()
+            conn.commit(); _invalidate_welcome_cache()
             if result.rowcount > 0:
                 logger.info(f"Updated welcome message template: '{name}'")
                 return True
@@ -2930,11 +3310,11 @@ def update_welcome_message_template(name: str, new_template_text: str | None = N
 def delete_welcome_message_template(name: str) -> bool:
     """Deletes a welcome message template."""
     try:
-        with get_db_connection() as conn:
+        with db_pool.acquire_writer() as conn:
             c = conn.cursor()
             # Check if it's the active one (handled better in admin logic now)
             result = c.execute("DELETE FROM welcome_messages WHERE name = ?", (name,))
-            conn.commit()
+            conn.commit(); _invalidate_welcome_cache()
             if result.rowcount > 0:
                 logger.info(f"Deleted welcome message template: '{name}'")
                 return True
@@ -2948,7 +3328,7 @@ def delete_welcome_message_template(name: str) -> bool:
 def set_active_welcome_message(name: str) -> bool:
     """Sets the active welcome message template name in bot_settings."""
     try:
-        with get_db_connection() as conn:
+        with db_pool.acquire_writer() as conn:
             c = conn.cursor()
             # First check if the template name actually exists
             c.execute("SELECT 1 FROM welcome_messages WHERE name = ?", (name,))
@@ -2958,7 +3338,7 @@ def set_active_welcome_message(name: str) -> bool:
             # Update or insert the setting
             c.execute("INSERT OR REPLACE INTO bot_settings (setting_key, setting_value) VALUES (?, ?)",
                       ("active_welcome_message_name", name))
-            conn.commit()
+            conn.commit(); _invalidate_welcome_cache()
             logger.info(f"Set active welcome message template to: '{name}'")
             return True
     except sqlite3.Error as e:
@@ -2984,273 +3364,337 @@ ABANDONED_RESERVATION_TIMEOUT_MINUTES = 30  # Timeout for items reserved but pay
 ABANDONED_RESERVATION_TIMEOUT_SECONDS = ABANDONED_RESERVATION_TIMEOUT_MINUTES * 60
 logger.info(f"Abandoned reservation timeout set to {ABANDONED_RESERVATION_TIMEOUT_MINUTES} minutes.")
 
-# Global dictionary to track reservation timestamps
-_reservation_timestamps = {}  # {user_id: {'timestamp': time.time(), 'snapshot': [...], 'type': 'single'/'basket'}}
+@dataclass(slots=True)
+class Reservation:
+    """Tracked reservation for one user (slotted: much smaller than a per-user dict)."""
+    expires_at: float
+    snapshot: list
+    type: str # 'single' or 'basket'
+
+# Global dictionary to track reservations
+_reservation_timestamps: dict[int, Reservation] = {}
+# Min-heap of (expires_at, user_id) so cleanup only visits expired entries.
+# Entries are deleted lazily: one is stale if the dict no longer holds a reservation with that expires_at.
+_reservation_heap: list[tuple[float, int]] = []
+_reservation_lock = threading.Lock() # Scheduler thread and request handlers both touch the dict/heap
 
 def track_reservation(user_id: int, snapshot: list, reservation_type: str):
     """Track when a user reserves items so we can clean up abandoned reservations."""
-    global _reservation_timestamps
-    _reservation_timestamps[user_id] = {
-        'timestamp': time.time(),
-        'snapshot': snapshot,
-        'type': reservation_type
-    }
+    expires_at = time.time() + ABANDONED_RESERVATION_TIMEOUT_SECONDS
+    with _reservation_lock:
+        _reservation_timestamps[user_id] = Reservation(expires_at, snapshot, reservation_type)
+        heapq.heappush(_reservation_heap, (expires_at, user_id))
     logger.debug(f"Tracking {reservation_type} reservation for user {user_id}: {len(snapshot)} items")
 
 def clear_reservation_tracking(user_id: int):
     """Clear reservation tracking when user proceeds to payment or cancels."""
-    global _reservation_timestamps
-    if user_id in _reservation_timestamps:
-        logger.debug(f"Cleared reservation tracking for user {user_id}")
-        del _reservation_timestamps[user_id]
+    with _reservation_lock:
+        if _reservation_timestamps.pop(user_id, None) is not None: # Heap entry goes stale and is skipped later
+            logger.debug(f"Cleared reservation tracking for user {user_id}")
 
 def clean_abandoned_reservations():
     """Clean up items reserved by users who abandoned the payment flow without proceeding to invoice creation."""
-    global _reservation_timestamps
-    
     current_time = time.time()
-    cutoff_time = current_time - ABANDONED_RESERVATION_TIMEOUT_SECONDS
-    
-    abandoned_users = []
+    abandoned = [] # (user_id, Reservation) claimed under the lock, unreserved outside it
     
-    # Find users with abandoned reservations
-    for user_id, reservation_data in _reservation_timestamps.items():
-        if reservation_data['timestamp'] < cutoff_time:
-            abandoned_users.append(user_id)
+    # Pop only the expired heap entries; skip stale ones (cleared or re-tracked since)
+    with _reservation_lock:
+        while _reservation_heap and _reservation_heap[0][0] <= current_time:
+            expires_at, user_id = heapq.heappop(_reservation_heap)
+            reservation = _reservation_timestamps.get(user_id)
+            if reservation is not None and reservation.expires_at == expires_at:
+                del _reservation_timestamps[user_id]
+                abandoned.append((user_id, reservation))
     
-    if not abandoned_users:
+    if not abandoned:
         logger.debug("No abandoned reservations found.")
         return
     
-    logger.info(f"Found {len(abandoned_users)} users with abandoned reservations to clean up.")
+    logger.info(f"Found {len(abandoned)} users with abandoned reservations to clean up.")
     
     # Process each abandoned reservation
     cleaned_count = 0
-    for user_id in abandoned_users:
+    for user_id, reservation in abandoned:
         try:
-            reservation_data = _reservation_timestamps.get(user_id)
-            if not reservation_data:
-                continue
-                
-            snapshot = reservation_data['snapshot']
-            reservation_type = reservation_data['type']
+            snapshot = reservation.snapshot
+            reservation_type = reservation.type
             
             # Unreserve the items
             _unreserve_basket_items(snapshot)
             
-            # Remove from tracking
-            del _reservation_timestamps[user_id]
-            
             cleaned_count += 1
             logger.info(f"Cleaned up abandoned {reservation_type} reservation for user {user_id}: {len(snapshot)} items unreserved")
             
         except Exception as e:
             logger.error(f"Error cleaning up abandoned reservation for user {user_id}: {e}", exc_info=True)
     
-    logger.info(f"Cleaned up {cleaned_count}/{len(abandoned_users)} abandoned reservations.")
+    logger.info(f"Cleaned up {cleaned_count}/{len(abandoned)} abandoned reservations.")
 
 # --- NEW: Clean up expired pending payments and unreserve items ---
-def get_expired_payments_for_notification():
+def _fetch_expired_pending_purchases() -> list[tuple] | None:
     """
-    Gets information about expired pending payments for user notifications.
-    Returns a list of user info for notifications before the records are cleaned up.
+    Single scan of expired pending purchases shared by the notification and cleanup steps.
+    Rows: (payment_id, user_id, basket_snapshot_json, created_at, has_user, language).
+    Returns None on DB error.
     """
-    current_time = time.time()
-    cutoff_timestamp = current_time - PAYMENT_TIMEOUT_SECONDS
-    cutoff_datetime = datetime.fromtimestamp(cutoff_timestamp, tz=timezone.utc)
-    
-    user_notifications = []
+    cutoff_datetime = datetime.fromtimestamp(time.time() - PAYMENT_TIMEOUT_SECONDS, tz=timezone.utc)
     conn = None
-    
     try:
         conn = get_db_connection()
         c = conn.cursor()
-        
-        # Find expired pending purchases and get user language info
+        c.row_factory = None # Rows are unpacked positionally by the callers
+        # Range scan on idx_pending_deposits_purchase_created (is_purchase = 1 AND created_at < ?), already in ORDER BY order
+        # SAFETY: Paid/swept orders never expire here - they belong to payment recovery, which keeps retrying
+        # past PAYMENT_TIMEOUT_MINUTES and reports the ones it gives up on to the admin.
         c.execute("""
-            SELECT pd.user_id, u.language
+            SELECT pd.payment_id, pd.user_id, pd.basket_snapshot_json, pd.created_at,
+                   u.user_id IS NOT NULL, u.language
             FROM pending_deposits pd
-            JOIN users u ON pd.user_id = u.user_id
-            WHERE pd.is_purchase = 1 
-            AND pd.created_at < ? 
+            LEFT JOIN users u ON pd.user_id = u.user_id
+            WHERE pd.is_purchase = 1
+            AND pd.created_at < ?
+            AND NOT EXISTS (
+                SELECT 1 FROM solana_wallets sw
+                WHERE sw.order_id = pd.payment_id AND sw.status IN ('paid', 'swept')
+            )
             ORDER BY pd.created_at
         """, (cutoff_datetime.isoformat(),))
-        
-        expired_records = c.fetchall()
-        
-        for record in expired_records:
-            user_notifications.append({
-                'user_id': record['user_id'],
-                'language': record['language'] or 'en'
-            })
-            
+        return c.fetchall()
     except sqlite3.Error as e:
-        logger.error(f"DB error while getting expired payments for notification: {e}", exc_info=True)
+        logger.error(f"DB error while fetching expired pending payments: {e}", exc_info=True)
+        return None
     finally:
         if conn:
             conn.close()
-    
+
+def _expired_payment_notifications(expired_records: list[tuple]) -> list[dict]:
+    # Only users that still exist get a notification (matches the old inner JOIN)
+    return [{'user_id': user_id, 'language': language or 'en'}
+            for _, user_id, _, _, has_user, language in expired_records if has_user]
+
+def get_expired_payments_for_notification():
+    """
+    Gets information about expired pending payments for user notifications.
+    Returns a list of user info for notifications before the records are cleaned up.
+    """
+    expired_records = _fetch_expired_pending_purchases()
+    return _expired_payment_notifications(expired_records) if expired_records else []
+
+
+def collect_and_clean_expired_payments() -> list[dict]:
+    """
+    Scheduler entry point: scans expired pending purchases ONCE, cleans them up,
+    and returns the user notifications for them (same shape as get_expired_payments_for_notification).
+    """
+    expired_records = _fetch_expired_pending_purchases()
+    if expired_records is None:
+        return []
+    user_notifications = _expired_payment_notifications(expired_records)
+    clean_expired_pending_payments(expired_records)
     return user_notifications
 
 
-def clean_expired_pending_payments():
+def clean_expired_pending_payments(expired_records: list[tuple] | None = None):
     """
     Checks for pending payments that have expired (older than PAYMENT_TIMEOUT_SECONDS)
     and automatically unreserves the items and removes the pending records.
+    Pass rows from _fetch_expired_pending_purchases() to reuse an existing scan.
     """
     logger.info("Running scheduled job: clean_expired_pending_payments")
-    
-    current_time = time.time()
-    cutoff_timestamp = current_time - PAYMENT_TIMEOUT_SECONDS
-    cutoff_datetime = datetime.fromtimestamp(cutoff_timestamp, tz=timezone.utc)
-    
-    expired_purchases = []
-    conn = None
-    
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        # Find expired pending purchases (not refills) older than cutoff time
-        c.execute("""
-            SELECT payment_id, user_id, basket_snapshot_json, created_at
-            FROM pending_deposits 
-            WHERE is_purchase = 1 
-            AND created_at < ? 
-            ORDER BY created_at
-        """, (cutoff_datetime.isoformat(),))
-        
-        expired_records = c.fetchall()
-        
-        if not expired_records:
-            logger.debug("No expired pending payments found.")
+
+    if expired_records is None:
+        expired_records = _fetch_expired_pending_purchases()
+        if expired_records is None:
             return
-            
-        logger.info(f"Found {len(expired_records)} expired pending payments to clean up.")
-        
-        for record in expired_records:
-            payment_id = record['payment_id']
-            user_id = record['user_id']
-            basket_snapshot_json = record['basket_snapshot_json']
-            created_at = record['created_at']
-            
-            logger.info(f"Processing expired payment {payment_id} for user {user_id} (created: {created_at})")
-            
-            # Deserialize basket snapshot if present
-            basket_snapshot = None
-            if basket_snapshot_json:
-                try:
-                    basket_snapshot = json.loads(basket_snapshot_json)
-                except json.JSONDecodeError as e:
-                    logger.error(f"Failed to decode basket_snapshot_json for expired payment {payment_id}: {e}")
-                    basket_snapshot = None
-            
-            # Collect info for later processing
-            expired_purchases.append({
-                'payment_id': payment_id,
-                'user_id': user_id,
-                'basket_snapshot': basket_snapshot
-            })
-            
+
+    expired_snapshots = {}
+
+    if not expired_records:
+        logger.debug("No expired pending payments found.")
+        return
+
+    logger.info(f"Found {len(expired_records)} expired pending payments to clean up.")
+
+    for payment_id, user_id, basket_snapshot_json, created_at, _, _ in expired_records:
+        logger.info(f"Processing expired payment {payment_id} for user {user_id} (created: {created_at})")
+
+        # Deserialize basket snapshot if present
+        basket_snapshot = None
+        if basket_snapshot_json:
+            try:
+                basket_snapshot = json.loads(basket_snapshot_json)
+            except json.JSONDecodeError as e:
+                logger.error(f"Failed to decode basket_snapshot_json for expired payment {payment_id}: {e}")
+                basket_snapshot = None
+
+        expired_snapshots[payment_id] = basket_snapshot
+
+    # Remove all expired records and release their reservations in one transaction
+    try:
+        deleted_ids = _remove_pending_deposits_bulk(list(expired_snapshots), trigger="timeout_expiry", basket_snapshots=expired_snapshots)
     except sqlite3.Error as e:
-        logger.error(f"DB error while checking expired pending payments: {e}", exc_info=True)
+        logger.error(f"DB error removing {len(expired_snapshots)} expired pending payments: {e}", exc_info=True)
         return
-    finally:
-        if conn:
-            conn.close()
-    
-    # Process each expired payment
-    processed_count = 0
-    for expired_payment in expired_purchases:
-        payment_id = expired_payment['payment_id']
-        user_id = expired_payment['user_id']
-        basket_snapshot = expired_payment['basket_snapshot']
-        
-        try:
-            # Remove the pending deposit record (this will trigger unreserving via remove_pending_deposit)
-            success = remove_pending_deposit(payment_id, trigger="timeout_expiry")
-            if success:
-                processed_count += 1
-                logger.info(f"Successfully cleaned up expired payment {payment_id} for user {user_id}")
-            else:
-                logger.warning(f"Failed to remove expired pending payment {payment_id} for user {user_id}")
-                
-        except Exception as e:
-            logger.error(f"Error processing expired payment {payment_id} for user {user_id}: {e}", exc_info=True)
-    
-    logger.info(f"Cleaned up {processed_count}/{len(expired_purchases)} expired pending payments.")
+
+    logger.info(f"Cleaned up {len(deleted_ids)}/{len(expired_snapshots)} expired pending payments.")
 
 
 # ============================================================================
 # BULLETPROOF PAYMENT RECOVERY SYSTEM
 # ============================================================================
 
-def get_failed_payments_for_recovery():
-    """Get all payments that failed during processing and need recovery.
-    SAFETY: Only returns payments that haven't been processed in solana_wallets."""
+@lru_cache(maxsize=512)
+def _parse_basket_snapshot(payment_id: str, raw_json: str) -> list | None:
+    """Parsed basket_snapshot_json, cached across recovery cycles (a stuck payment is re-scanned every run).
+    The (payment_id, raw_json) key never changes for a row, so LRU eviction is the only invalidation needed.
+    The returned list is shared between calls - treat it as read-only."""
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        # FIXED: Use correct column name basket_snapshot_json
-        # SAFETY: Exclude payments that are already marked as 'paid' in solana_wallets
-        c.execute("""
-            SELECT pd.payment_id, pd.user_id, pd.target_eur_amount, pd.currency, pd.expected_crypto_amount,
-                   pd.basket_snapshot_json, pd.discount_code_used, pd.created_at
-            FROM pending_deposits pd
-            LEFT JOIN solana_wallets sw ON pd.payment_id = sw.order_id
-            WHERE pd.created_at < datetime('now', '-10 minutes')
-            AND pd.is_purchase = 1
-            AND (sw.status IS NULL OR sw.status = 'pending')
-            ORDER BY pd.created_at ASC
-        """)
+        return _fast_json_loads(raw_json)
+    except json.JSONDecodeError: # orjson.JSONDecodeError subclasses it
+        logger.error(f"Failed to parse basket_snapshot_json for payment {payment_id}")
+        return None
+
+# FIXED: Use correct column name basket_snapshot_json
+# SAFETY: Only payments whose wallet was actually PAID (and possibly swept since) but whose pending row is still
+# here, i.e. the deposit checker marked it paid and then failed to finalize. Unpaid ('pending') orders must
+# never be finalized here. The paid mark must be older than the cutoff too, so a payment the checker is still
+# finalizing right now isn't picked up a second time. One UNIQUE(order_id) probe per candidate.
+_RECOVERY_SQL = """
+    SELECT pd.payment_id, pd.user_id, pd.target_eur_amount, pd.currency, pd.expected_crypto_amount,
+           pd.basket_snapshot_json, pd.discount_code_used, pd.created_at, pd.retry_count, pd.bot_id
+    FROM pending_deposits pd
+    WHERE pd.is_purchase = 1
+    AND pd.created_at < :cutoff_10m
+    AND (pd.next_retry_at IS NULL OR pd.next_retry_at <= :now)
+    AND COALESCE(pd.retry_count, 0) < :max_retries
+    AND EXISTS (
+        SELECT 1 FROM solana_wallets sw
+        WHERE sw.order_id = pd.payment_id AND sw.status IN ('paid', 'swept')
+        AND sw.updated_at < :cutoff_10m
+    )
+    ORDER BY pd.created_at ASC -- free: idx_pending_deposits_purchase_created already yields this order (no sort step)
+"""
+RECOVERY_MIN_AGE_MINUTES = 10
+# Failed attempts back off exponentially (base * 2^n, capped at 2^6) with +/-20% jitter so stuck payments
+# don't hammer Telegram / Solana RPC every cycle; after RECOVERY_MAX_RETRIES the row is no longer polled
+# (it stays in pending_deposits until the normal expiry cleanup releases it).
+RECOVERY_BACKOFF_BASE_SECONDS = 60
+RECOVERY_MAX_RETRIES = 10
+
+def _sqlite_utc_text(dt: datetime) -> str:
+    # Same text SQLite's datetime('now', ...) produces ('YYYY-MM-DD HH:MM:SS', UTC), so binding these
+    # instead of calling datetime() in SQL leaves every comparison against created_at unchanged.
+    return dt.strftime('%Y-%m-%d %H:%M:%S')
+
+def _tick_cutoffs(now: datetime | None = None) -> dict:
+    """Cutoff strings for one BULLETPROOF tick, computed once and bound as parameters by every query in it."""
+    now = now or datetime.now(timezone.utc)
+    return {
+        'now': _sqlite_utc_text(now),
+        'cutoff_10m': _sqlite_utc_text(now - timedelta(minutes=RECOVERY_MIN_AGE_MINUTES)),
+        'cutoff_30m': _sqlite_utc_text(now - timedelta(minutes=30)),
+        'cutoff_1h': _sqlite_utc_text(now - timedelta(hours=1)),
+    }
+
+def _recovery_query_params(cutoffs: dict | None = None) -> dict:
+    cutoffs = cutoffs or _tick_cutoffs()
+    return {'cutoff_10m': cutoffs['cutoff_10m'], 'now': cutoffs['now'], 'max_retries': RECOVERY_MAX_RETRIES}
+
+def _schedule_recovery_retries(failed_payments: list[dict]) -> list[str]:
+    """Bumps retry_count and pushes next_retry_at out for payments whose recovery attempt failed.
+    Returns the payment_ids that just used up their last attempt (they are no longer polled)."""
+    now = datetime.now(timezone.utc)
+    updates, given_up_ids = [], []
+    for payment in failed_payments:
+        retry_count = payment.get('retry_count') or 0
+        delay = RECOVERY_BACKOFF_BASE_SECONDS * (1 << min(retry_count, 6)) * random.uniform(0.8, 1.2)
+        updates.append((_sqlite_utc_text(now + timedelta(seconds=delay)), payment['payment_id']))
+        if retry_count + 1 >= RECOVERY_MAX_RETRIES:
+            logger.warning(f"⚠️ BULLETPROOF RECOVERY: Giving up on payment {payment['payment_id']} after {retry_count + 1} failed attempts")
+            given_up_ids.append(payment['payment_id'])
+    try:
+        with db_pool.acquire_writer() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("UPDATE pending_deposits SET retry_count = COALESCE(retry_count, 0) + 1, next_retry_at = ? WHERE payment_id = ?", updates)
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"❌ BULLETPROOF: DB error scheduling retries for {len(updates)} payments: {e}", exc_info=True)
+        return []
+    return given_up_ids
+
+def iter_failed_payments_for_recovery(cutoffs: dict | None = None) -> Iterator[dict]:
+    """Yields payments that failed during processing and need recovery, straight from the cursor.
+    SAFETY: Only yields payments marked paid in solana_wallets that were never finalized.
+    A pooled reader connection is held until the generator is exhausted or closed."""
+    try:
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
+            c.row_factory = sqlite3.Row
+            c.arraysize = 64 # Rows are pulled from SQLite in small batches while iterating
         
-        failed_payments = []
-        for row in c.fetchall():
-            # Parse basket_snapshot_json back to list
-            basket_snapshot = None
-            if row[5]:  # basket_snapshot_json
-                try:
-                    basket_snapshot = json.loads(row[5])
-                except json.JSONDecodeError:
-                    logger.error(f"Failed to parse basket_snapshot_json for payment {row[0]}")
-                    basket_snapshot = None
-            
-            failed_payments.append({
-                'payment_id': row[0],
-                'user_id': row[1],
-                'target_eur_amount': row[2],
-                'currency': row[3],
-                'expected_crypto_amount': row[4],
-                'basket_snapshot': basket_snapshot,  # Now properly parsed
-                'discount_code_used': row[6],
-                'created_at': row[7]
-            })
+            c.execute(_RECOVERY_SQL, _recovery_query_params(cutoffs))
         
-        conn.close()
-        return failed_payments
+            for row in c: # sqlite3.Row (pool default): keys are the selected column names
+                payment = dict(row)
+                # Parse basket_snapshot_json back to list
+                raw_snapshot = payment.pop('basket_snapshot_json')
+                payment['basket_snapshot'] = _parse_basket_snapshot(payment['payment_id'], raw_snapshot) if raw_snapshot else None
+                yield payment
     except Exception as e:
         logger.error(f"Error getting failed payments for recovery: {e}")
-        return []
 
 
-def recover_failed_payment(payment_id, user_id, basket_snapshot, discount_code_used, dummy_context):
-    """Attempt to recover a failed payment by reprocessing it"""
+def get_failed_payments_for_recovery():
+    """Get all payments that failed during processing and need recovery (list form of iter_failed_payments_for_recovery)."""
+    return list(iter_failed_payments_for_recovery())
+
+
+# payment imports utils, so process_successful_crypto_purchase is resolved on first use, not at module load.
+_process_fn = None
+
+def _get_process_fn():
+    global _process_fn
+    if _process_fn is None:
+        from payment import process_successful_crypto_purchase as _process_fn
+    return _process_fn
+
+
+RECOVERY_ATTEMPT_TIMEOUT_SECONDS = 120
+
+def _remove_pending_after_late_recovery(future, payment_id):
+    # Done-callback for an attempt that outlived RECOVERY_ATTEMPT_TIMEOUT_SECONDS: if it did finalize,
+    # drop the pending row now so a later retry can't deliver the same order twice.
+    if not future.cancelled() and future.exception() is None and future.result():
+        logger.info(f"✅ BULLETPROOF RECOVERY: Payment {payment_id} finalized after the attempt timed out")
+        remove_pending_deposit(payment_id, trigger="recovery_success")
+
+def recover_failed_payment(payment_id, user_id, basket_snapshot, discount_code_used, dummy_context, remove_pending=True, bot_id=None):
+    """Attempt to recover a failed payment by reprocessing it.
+    Blocks the calling (worker) thread while the purchase runs on the bot loop - never call it from the loop.
+    Returns True/False for an awaited result, None if the attempt was still running at the timeout.
+    remove_pending=False leaves the pending_deposits row for the caller to delete in bulk."""
     try:
         logger.info(f"🔄 BULLETPROOF RECOVERY: Attempting to recover payment {payment_id} for user {user_id}")
         
-        # Import here to avoid circular imports
-        from payment import process_successful_crypto_purchase
-        
-        # Process the payment again
-        success = process_successful_crypto_purchase(
-            user_id, basket_snapshot, discount_code_used, payment_id, dummy_context
-        )
+        # Process the payment again (a coroutine: it runs on the bot loop and this thread waits for its result)
+        future = _submit_to_bot_loop(_get_process_fn()(
+            user_id, basket_snapshot, discount_code_used, payment_id, dummy_context, bot_id=bot_id
+        ))
+        if future is None:
+            return False
+        try:
+            success = future.result(timeout=RECOVERY_ATTEMPT_TIMEOUT_SECONDS)
+        except TimeoutError:
+            # Not cancelled: interrupting a half-finalized purchase is worse than letting it finish
+            future.add_done_callback(lambda f: _remove_pending_after_late_recovery(f, payment_id))
+            logger.warning(f"⚠️ BULLETPROOF RECOVERY: Payment {payment_id} still processing after {RECOVERY_ATTEMPT_TIMEOUT_SECONDS}s")
+            return None
         
         if success:
             logger.info(f"✅ BULLETPROOF RECOVERY: Successfully recovered payment {payment_id} for user {user_id}")
             # Remove from pending deposits
-            remove_pending_deposit(payment_id, trigger="recovery_success")
+            if remove_pending:
+                remove_pending_deposit(payment_id, trigger="recovery_success")
             return True
         else:
             logger.warning(f"⚠️ BULLETPROOF RECOVERY: Failed to recover payment {payment_id} for user {user_id}")
@@ -3261,60 +3705,145 @@ def recover_failed_payment(payment_id, user_id, basket_snapshot, discount_code_u
         return False
 
 
-def run_payment_recovery_job():
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def _chunk_message_lines(lines: list[str], limit: int = TELEGRAM_MESSAGE_LIMIT) -> list[str]:
+    """Joins lines into as few messages as possible, each at most `limit` characters."""
+    chunks, current = [], ""
+    for line in lines:
+        line = line[:limit]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current); current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current: chunks.append(current)
+    return chunks
+
+async def _send_admin_message_chunks(bot, admin_id: int, chunks: list[str]):
+    for chunk in chunks:
+        await send_message_with_retry(bot, admin_id, chunk, parse_mode=None)
+
+def _submit_to_bot_loop(coro):
+    """Schedule a coroutine from a worker thread on the bot's running event loop (fire-and-forget).
+    asyncio.get_event_loop() in a worker thread gives a loop nobody runs, so the coroutine would never execute.
+    The bot's own loop (registered via set_bot_loop) is used, not a separate one, because
+    telegram_app.bot's HTTP client belongs to it."""
+    if _bot_loop is None or not _bot_loop.is_running():
+        coro.close() # Avoid the "never awaited" warning
+        logger.error(f"Bot event loop not registered/running (set_bot_loop); could not run {coro.__qualname__}.")
+        return None
+    return asyncio.run_coroutine_threadsafe(coro, _bot_loop)
+
+
+_RECOVERY_OUTCOME_TEXT = {
+    'recovered': "✅ {label}",
+    'failed': "⚠️ {label} - failed, retry scheduled",
+    'timeout': "⏳ {label} - no result within the attempt timeout, retry scheduled",
+    'error': "❌ {label} - error, retry scheduled",
+}
+
+def _recovery_summary_lines(outcomes: list[tuple[dict, str]], given_up_ids: list[str]) -> list[str]:
+    """One admin summary line per awaited recovery attempt."""
+    given_up = set(given_up_ids)
+    lines = []
+    for payment, outcome in outcomes:
+        label = f"{payment['payment_id']} (user {payment['user_id']})"
+        if payment['payment_id'] in given_up:
+            lines.append(f"🛑 {label} - {outcome}, gave up after {RECOVERY_MAX_RETRIES} attempts, manual check needed")
+        else:
+            lines.append(_RECOVERY_OUTCOME_TEXT[outcome].format(label=label))
+    return lines
+
+
+RECOVERY_MAX_WORKERS = 8 # Concurrent recovery attempts: each worker waits on one purchase running on the bot loop
+
+def _recover_payment_task(payment: dict, telegram_app) -> bool:
+    """One recovery attempt, run on a recovery worker thread. Leaves the pending row for the caller."""
+    # Create dummy context
+    dummy_context = ContextTypes.DEFAULT_TYPE(
+        application=telegram_app, 
+        chat_id=payment['user_id'], 
+        user_id=payment['user_id']
+    )
+    
+    # Attempt recovery
+    return recover_failed_payment(
+        payment['payment_id'], 
+        payment['user_id'], 
+        payment['basket_snapshot'], 
+        payment['discount_code_used'], 
+        dummy_context,
+        remove_pending=False,
+        bot_id=payment.get('bot_id')
+    )
+
+
+def run_payment_recovery_job(cutoffs: dict | None = None):
     """Run the payment recovery job to process failed payments"""
     try:
         logger.info("🔄 BULLETPROOF: Starting payment recovery job")
         
-        failed_payments = get_failed_payments_for_recovery()
-        if not failed_payments:
-            logger.info("✅ BULLETPROOF: No failed payments found for recovery")
-            return
-        
-        logger.info(f"🔄 BULLETPROOF: Found {len(failed_payments)} failed payments for recovery")
-        
-        # Import here to avoid circular imports
-        from main import telegram_app, get_first_primary_admin_id, send_message_with_retry
+        telegram_app = _bot_app
         
         if not telegram_app:
             logger.error("❌ BULLETPROOF: Telegram app not available for recovery")
             return
+        if _bot_loop is None or not _bot_loop.is_running():
+            # Attempts can't be awaited without it; don't spend retries on payments that were never tried
+            logger.error("❌ BULLETPROOF: Bot event loop not running; skipping payment recovery")
+            return
+        
+        found_count = 0
+        recovered_ids = [] # pending_deposits rows removed in one transaction after the loop
+        retry_payments = [] # failed attempts: backed off in one transaction after the loop
+        outcomes = [] # (payment, awaited outcome) per attempt, summarized for the admin after the loop
+        # Attempts are network-bound, so up to RECOVERY_MAX_WORKERS interleave on the bot loop; workers leave the
+        # pending rows alone (removal and retry scheduling are batched below).
+        # Payments are submitted as rows stream in, so the first attempts start before the scan finishes.
+        with ThreadPoolExecutor(max_workers=RECOVERY_MAX_WORKERS, thread_name_prefix="payment-recovery") as executor:
+            futures = {}
+            for payment in iter_failed_payments_for_recovery(cutoffs):
+                found_count += 1
+                futures[executor.submit(_recover_payment_task, payment, telegram_app)] = payment
+            
+            if futures:
+                logger.info(f"🔄 BULLETPROOF: Found {found_count} failed payments for recovery")
+            for future in as_completed(futures):
+                payment = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f"❌ BULLETPROOF: Error processing recovery for payment {payment['payment_id']}: {e}")
+                    result = 'error'
+                if result is True:
+                    recovered_ids.append(payment['payment_id'])
+                    outcomes.append((payment, 'recovered'))
+                else:
+                    retry_payments.append(payment)
+                    outcomes.append((payment, {False: 'failed', None: 'timeout'}.get(result, 'error')))
+        
+        if not found_count:
+            logger.info("✅ BULLETPROOF: No failed payments found for recovery")
+            return
         
-        recovered_count = 0
-        for payment in failed_payments:
+        recovered_count = len(recovered_ids)
+        if recovered_ids:
             try:
-                # Create dummy context
-                dummy_context = ContextTypes.DEFAULT_TYPE(
-                    application=telegram_app, 
-                    chat_id=payment['user_id'], 
-                    user_id=payment['user_id']
-                )
-                
-                # Attempt recovery
-                if recover_failed_payment(
-                    payment['payment_id'], 
-                    payment['user_id'], 
-                    payment['basket_snapshot'], 
-                    payment['discount_code_used'], 
-                    dummy_context
-                ):
-                    recovered_count += 1
-                    
-            except Exception as e:
-                logger.error(f"❌ BULLETPROOF: Error processing recovery for payment {payment['payment_id']}: {e}")
+                _remove_pending_deposits_bulk(recovered_ids, trigger="recovery_success")
+            except sqlite3.Error as e:
+                logger.error(f"❌ BULLETPROOF: DB error removing {recovered_count} recovered pending deposits: {e}", exc_info=True)
+        given_up_ids = _schedule_recovery_retries(retry_payments) if retry_payments else []
         
-        logger.info(f"✅ BULLETPROOF: Payment recovery completed. Recovered {recovered_count}/{len(failed_payments)} payments")
+        logger.info(f"✅ BULLETPROOF: Payment recovery completed. Recovered {recovered_count}/{found_count} payments")
         
-        # Notify admin about recovery results
-        if get_first_primary_admin_id() and recovered_count > 0:
+        # Notify admin about recovery results (one summary, split only if it exceeds Telegram's message limit)
+        admin_id = get_first_primary_admin_id()
+        # Paid orders that ran out of attempts are always reported: nothing retries them after this
+        if admin_id and (recovered_count > 0 or given_up_ids):
             try:
-                asyncio.run_coroutine_threadsafe(
-                    send_message_with_retry(
-                        telegram_app.bot, 
-                        get_first_primary_admin_id(), 
-                        f"🔄 BULLETPROOF RECOVERY: Recovered {recovered_count}/{len(failed_payments)} failed payments"
-                    ),
-                    asyncio.get_event_loop()
+                header = f"🔄 BULLETPROOF RECOVERY: Recovered {recovered_count}/{found_count} failed payments"
+                _submit_to_bot_loop(
+                    _send_admin_message_chunks(telegram_app.bot, admin_id, _chunk_message_lines([header, *_recovery_summary_lines(outcomes, given_up_ids)]))
                 )
             except Exception as e:
                 logger.error(f"Error notifying admin about recovery: {e}")
@@ -3323,54 +3852,31 @@ def run_payment_recovery_job():
         logger.error(f"❌ BULLETPROOF: Error in payment recovery job: {e}")
 
 
-def add_payment_recovery_scheduler(scheduler):
-    """Add payment recovery job to the scheduler"""
-    try:
-        # Run recovery job every 5 minutes
-        scheduler.add_job(
-            run_payment_recovery_job,
-            'interval',
-            minutes=5,
-            id='payment_recovery_job',
-            replace_existing=True
-        )
-        logger.info("✅ BULLETPROOF: Payment recovery scheduler added (every 5 minutes)")
-    except Exception as e:
-        logger.error(f"❌ BULLETPROOF: Error adding payment recovery scheduler: {e}")
-
-
 # ============================================================================
 # BULLETPROOF MONITORING AND ALERTING
 # ============================================================================
 
-def check_payment_system_health():
+def check_payment_system_health(cutoffs: dict | None = None):
     """Check the overall health of the payment system"""
+    cutoffs = cutoffs or _tick_cutoffs()
     try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        
-        # Check for stuck payments
-        c.execute("""
-            SELECT COUNT(*) FROM pending_deposits 
-            WHERE created_at < datetime('now', '-30 minutes')
-            AND is_purchase = 1
-        """)
-        stuck_payments = c.fetchone()[0]
-        
-        # Check for recent failures
-        c.execute("""
-            SELECT COUNT(*) FROM pending_deposits 
-            WHERE created_at > datetime('now', '-1 hour')
-            AND is_purchase = 1
-        """)
-        recent_payments = c.fetchone()[0]
+        with db_pool.acquire() as conn:
+            c = conn.cursor()
         
-        conn.close()
+            # Stuck payments and recent payments counted in ONE pass over the is_purchase = 1 rows
+            # (covering (is_purchase, created_at) index); COALESCE because SUM over zero rows is NULL
+            c.execute("""
+                SELECT COALESCE(SUM(CASE WHEN created_at < :cutoff_30m THEN 1 ELSE 0 END), 0) AS stuck,
+                       COALESCE(SUM(CASE WHEN created_at > :cutoff_1h THEN 1 ELSE 0 END), 0) AS recent
+                FROM pending_deposits
+                WHERE is_purchase = 1
+            """, {'cutoff_30m': cutoffs['cutoff_30m'], 'cutoff_1h': cutoffs['cutoff_1h']})
+            stuck_payments, recent_payments = c.fetchone()
         
         health_status = {
             'stuck_payments': stuck_payments,
             'recent_payments': recent_payments,
-            'is_healthy': stuck_payments < 5 and recent_payments > 0
+            'is_healthy': stuck_payments < 5 # A quiet hour with no new payments isn't a fault
         }
         
         logger.info(f"🔍 BULLETPROOF HEALTH CHECK: Stuck payments: {stuck_payments}, Recent payments: {recent_payments}")
@@ -3384,21 +3890,43 @@ def check_payment_system_health():
 def send_health_alert(health_status):
     """Send health alert to admin if system is unhealthy"""
     try:
-        from main import telegram_app, get_first_primary_admin_id, send_message_with_retry
+        telegram_app = _bot_app
         
-        if not health_status.get('is_healthy', True) and get_first_primary_admin_id():
+        admin_id = get_first_primary_admin_id()
+        if not health_status.get('is_healthy', True) and admin_id:
+            if not telegram_app:
+                logger.error(f"❌ BULLETPROOF: Telegram app not registered; health alert not sent: {health_status}")
+                return
             message = f"🚨 BULLETPROOF ALERT: Payment system health issue detected!\n"
             message += f"Stuck payments: {health_status.get('stuck_payments', 0)}\n"
             message += f"Recent payments: {health_status.get('recent_payments', 0)}\n"
             message += f"Error: {health_status.get('error', 'Unknown')}"
             
-            asyncio.run_coroutine_threadsafe(
+            _submit_to_bot_loop(
                 send_message_with_retry(
                     telegram_app.bot, 
-                    get_first_primary_admin_id(), 
+                    admin_id, 
                     message
-                ),
-                asyncio.get_event_loop()
+                )
             )
     except Exception as e:
-        logger.error(f"❌ BULLETPROOF: Error sending health alert: {e}")
\ No newline at end of file
+        logger.error(f"❌ BULLETPROOF: Error sending health alert: {e}")
+
+
+HEALTH_ALERT_REPEAT_SECONDS = 3600 # While unhealthy, alert again at most this often (not every tick)
+_last_health_alert_at: float | None = None # time.monotonic() of the last alert; None while healthy
+
+def run_payment_recovery_tick():
+    """One BULLETPROOF tick (run by the bot's JobQueue): payment recovery, then the health check.
+    Alerts when the system becomes unhealthy, then every HEALTH_ALERT_REPEAT_SECONDS while it stays so."""
+    global _last_health_alert_at
+    cutoffs = _tick_cutoffs() # One clock reading shared by every query in the tick
+    run_payment_recovery_job(cutoffs)
+    health_status = check_payment_system_health(cutoffs)
+    if health_status.get('is_healthy', False):
+        _last_health_alert_at = None
+        return
+    now = time.monotonic()
+    if _last_health_alert_at is None or now - _last_health_alert_at >= HEALTH_ALERT_REPEAT_SECONDS:
+        send_health_alert(health_status)
+        _last_health_alert_at = now
\ No newline at end of file